@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""多数の曲をスレッドプールで並行にWAVファイルへ書き出すコマンド
+
+波形の計算の大部分はGILを解放するNumPyの演算なので，スレッドでも
+複数のCPUを使える．曲の読み込み(楽譜の組み立て)もワーカーの中で行う
+
+例:
+    python batch.py canon jupiter amazing_grace -d out
+    python batch.py main:canon myscore:build -d out -j 8 --format float32
+"""
+
+import argparse
+import concurrent.futures
+import os
+import sys
+import time
+
+from render import load_score, music_rate, render_to_wav
+from stream import BLOCK_SIZE
+from wavfile import FORMATS
+
+
+MAX_WORKERS = os.cpu_count() or 1
+
+
+class RenderJob(object):
+    """1曲をWAVファイルへ書き出す仕事
+
+    source : main.py/main2.pyのMusicかMusicPartのインスタンス，または
+             render.load_score()に渡す曲の名前("canon", "main:canon"など)
+    path : 書き出すファイルのパス
+    format : 'pcm16'または'float32'
+    volume : main2.pyの曲に掛ける音量
+    bpm : sourceが曲の名前の時に関数に渡すbpm
+    """
+
+    def __init__(self, source, path, format='pcm16', volume=0.1, bpm=None):
+        self.source = source
+        self.path = path
+        self.format = format
+        self.volume = volume
+        self.bpm = bpm
+
+    @property
+    def name(self):
+        if isinstance(self.source, str):
+            return self.source
+        return type(self.source).__name__
+
+    def run(self, block_size=BLOCK_SIZE):
+        """曲を書き出し，結果の辞書を返す"""
+        begin = time.perf_counter()
+        music = self.source
+        if isinstance(music, str):
+            music = load_score(music, self.bpm)
+        samples = render_to_wav(music, self.path, self.format, block_size,
+                                self.volume)
+        seconds = time.perf_counter() - begin
+        return {
+            'samples': samples,
+            'audio_seconds': samples / music_rate(music),
+            'wall_time': seconds,
+        }
+
+
+def iter_render_batch(jobs, max_workers=MAX_WORKERS, max_pending=None,
+                      block_size=BLOCK_SIZE):
+    """jobsをスレッドプールで実行し，終わった順に結果の辞書を返す
+
+    jobsは遅延評価のイテラブルでよく，実行中と待ち行列の仕事の数が
+    max_pending(省略時はmax_workersの2倍)を超えないように少しずつ
+    取り出す．失敗した仕事は例外を'error'に入れて返し，残りは続ける
+    """
+    max_pending = max_pending or 2 * max_workers
+    pending = {}
+
+    def result(future):
+        job = pending.pop(future)
+        entry = {'name': job.name, 'path': job.path}
+        try:
+            entry.update(future.result())
+        except Exception as e:
+            entry['error'] = '{}: {}'.format(type(e).__name__, e)
+        return entry
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        for job in jobs:
+            while len(pending) >= max_pending:  # 空きができるまで待つ
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield result(future)
+            pending[executor.submit(job.run, block_size)] = job
+
+        for future in concurrent.futures.as_completed(list(pending)):
+            yield result(future)
+
+
+def summarize(results, wall_time):
+    """全体の所要時間と処理量をまとめる"""
+    succeeded = [r for r in results if 'error' not in r]
+    samples = sum(r['samples'] for r in succeeded)
+    audio_seconds = sum(r['audio_seconds'] for r in succeeded)
+    return {
+        'jobs': len(results),
+        'failed': len(results) - len(succeeded),
+        'wall_time': wall_time,
+        'samples': samples,
+        'samples_per_sec': samples / wall_time if wall_time else None,
+        'realtime_factor': audio_seconds / wall_time if wall_time else None,
+    }
+
+
+def render_batch(jobs, max_workers=MAX_WORKERS, max_pending=None,
+                 block_size=BLOCK_SIZE):
+    """jobsを全て実行し，仕事ごとの結果と全体のまとめを返す"""
+    begin = time.perf_counter()
+    results = list(iter_render_batch(jobs, max_workers, max_pending,
+                                     block_size))
+    return {
+        'results': results,
+        'summary': summarize(results, time.perf_counter() - begin),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='多数の曲を並行にWAVファイルへ書き出す')
+    parser.add_argument('scores', nargs='+',
+                        help='曲の名前(canonなど)または"モジュール名:関数名"')
+    parser.add_argument('-d', '--directory', default='.',
+                        help='書き出し先のディレクトリ')
+    parser.add_argument('-j', '--jobs', type=int, default=MAX_WORKERS,
+                        help='スレッド数(デフォルト: CPU数)')
+    parser.add_argument('--max-pending', type=int,
+                        help='同時に受け付ける仕事の数(デフォルト: スレッド数の2倍)')
+    parser.add_argument('--format', choices=FORMATS, default='pcm16',
+                        help='サンプルの形式(デフォルト: pcm16)')
+    parser.add_argument('--volume', type=float, default=0.1,
+                        help='main2.pyの曲に掛ける音量(デフォルト: 0.1)')
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE,
+                        help='一度に生成・書き込みするサンプル数')
+    args = parser.parse_args()
+
+    os.makedirs(args.directory, exist_ok=True)
+
+    def jobs():
+        names = {}
+        for score in args.scores:
+            name = score.replace(':', '_')
+            names[name] = names.get(name, 0) + 1
+            if names[name] > 1:  # 同じ曲は番号を付けて別のファイルにする
+                name = '{}_{}'.format(name, names[name])
+            path = os.path.join(args.directory, name + '.wav')
+            yield RenderJob(score, path, args.format, args.volume)
+
+    begin = time.perf_counter()
+    results = []
+    for result in iter_render_batch(jobs(), args.jobs, args.max_pending,
+                                    args.block_size):
+        results.append(result)
+        if 'error' in result:
+            print('{name}: failed ({error})'.format(**result))
+        else:
+            print('{path}: {samples} samples, {wall_time:.3f} s'.format(
+                **result))
+
+    summary = summarize(results, time.perf_counter() - begin)
+    print('{jobs} jobs ({failed} failed) in {wall_time:.3f} s: '
+          '{samples_per_sec:.0f} samples/s, {realtime_factor:.1f}x '
+          'realtime'.format(**summary))
+    if summary['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
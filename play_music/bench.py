@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""main.py(MusicPart)とmain2.py(Series/Chord)の描画速度を比べるベンチマーク
+
+音声デバイスは使わず，波形を生成するまでの時間とメモリを測ってJSONで出力する．
+各計測の前に波形とエンベロープのキャッシュを空にする
+
+例:
+    python bench.py                      # 全ての曲を計測して標準出力へ
+    python bench.py -o bench.json        # ファイルへ書き出す
+    python bench.py --quick canon deep   # 小さめの合成曲で一部だけ計測
+    python bench.py --quality full preview  # previewの速さをfullと比べる
+"""
+
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import main as main1
+import main2
+from cache import wave_cache
+from envelope import envelope_cache
+from resample import QUALITIES
+
+
+MAIN2_MODES = ('inplace', 'recursive', 'compiled', 'iterative')
+SCALES = ['c4', 'd4', 'e4', 'f4', 'g4', 'a4', 'b4', 'c5', 'e3', 'g3', 'a3']
+LENGTHS = [0.25, 0.5, 0.5, 1, 1, 2]
+
+
+def synthetic_parts(n_parts, n_notes, seed=0):
+    """合成曲のパートごとの(音名のリスト, 長さ)の列を返す"""
+    rng = random.Random(seed)
+    return [[(rng.sample(SCALES, rng.randint(1, 3)), rng.choice(LENGTHS))
+             for _ in range(n_notes)]
+            for _ in range(n_parts)]
+
+
+def build_main(parts, bpm=120, quality='full'):
+    """パートの列からmain.pyのMusicを作る(この時点で波形が生成される)"""
+    music = main1.Music()
+    for events in parts:
+        part = main1.MusicPart(bpm=bpm, quality=quality)
+        for scales, length in events:
+            part.append_tone(scales, length)
+        music.add_part(part)
+    return music
+
+
+def build_main2(parts, bpm=120, depth=0):
+    """パートの列からmain2.pyのMusicを作る
+
+    depth > 0 の時は各パートの音符を1つずつSeriesで入れ子にした，
+    深さdepthの木にする
+    """
+    series_list = []
+    for events in parts:
+        if depth:
+            series = main2.Series()
+            node = series
+            for i, (scales, length) in enumerate(events, 1):
+                node.add_tone(scales, length)
+                if i < min(depth, len(events)):
+                    child = main2.Series()
+                    node.add(child)
+                    node = child
+        else:
+            series = main2.Series()
+            for scales, length in events:
+                series.add_tone(scales, length)
+        series_list.append(series)
+    score = main2.Chord(series_list, parallel=False)
+    return main2.Music(score, bpm=bpm, rate=main1.MusicPart.RATE)
+
+
+def render_main(music):
+    """main.pyの曲の出力(MusicPart.RATEの波形)を返す"""
+    if isinstance(music, main1.MusicPart):
+        return music.get_wave()
+    return music.mix()
+
+
+def workloads(quick=False):
+    """名前 -> (main.pyの曲を作る関数, main2.pyの曲を作る関数)の辞書
+
+    main.pyの曲は音符を追加する時に生成するので，関数にqualityを渡す
+    """
+    scale = 10 if quick else 1
+    notes = synthetic_parts(1, 10000 // scale)
+    parallel = synthetic_parts(100 // scale, 100)
+    nested = synthetic_parts(1, 200 // scale, seed=1)
+    return {
+        'amazing_grace': (main1.amazing_grace, main2.amazing_grace),
+        'canon': (main1.canon, main2.canon),
+        'jupiter': (main1.jupiter, main2.jupiter),
+        'notes': (lambda quality: build_main(notes, quality=quality),
+                  lambda: build_main2(notes)),
+        'parts': (lambda quality: build_main(parallel, quality=quality),
+                  lambda: build_main2(parallel)),
+        # main.pyには入れ子がないので同じ音符を平らに並べたものと比べる
+        'deep': (lambda quality: build_main(nested, quality=quality),
+                 lambda: build_main2(nested, depth=len(nested[0]))),
+    }
+
+
+def clear_caches():
+    """計測ごとに同じ条件から始めるため，波形のキャッシュを空にする"""
+    wave_cache.clear()
+    envelope_cache.clear()
+    main2.subtree_cache.clear()
+    gc.collect()
+
+
+def measure(run, repeat):
+    """run()の最短の実行時間と，生成したサンプル数，最大メモリ使用量を返す
+
+    最初に1度だけ計測せずにrun()を呼び，初回だけの読み込み(エンベロープで
+    使うscipyなど)を時間にもメモリにも含めない
+    """
+    run()  # ウォームアップ
+    best = float('inf')
+    for _ in range(repeat):
+        clear_caches()
+        begin = time.perf_counter()
+        wave = run()
+        best = min(best, time.perf_counter() - begin)
+        del wave
+
+    clear_caches()
+    tracemalloc.start()
+    samples = len(run())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'samples': samples,
+        'wall_time': best,
+        'samples_per_sec': samples / best if best else None,
+        'peak_bytes': peak,
+    }
+
+
+def run_benchmarks(names=None, repeat=3, quick=False, qualities=('full',)):
+    """ベンチマークを実行して結果の辞書を返す
+
+    qualitiesに'full'と他の品質を両方含めると，他の品質の結果に
+    同じ曲・エンジン・modeの'full'に対する速度の比'speedup'を加える
+    """
+    results = []
+    for name, (make_main, make_main2) in workloads(quick).items():
+        if names and name not in names:
+            continue
+
+        first = len(results)
+        for quality in qualities:
+            result = measure(lambda: render_main(make_main(quality)), repeat)
+            results.append(dict(workload=name, engine='main', mode=None,
+                                quality=quality, **result))
+            for mode in MAIN2_MODES:
+                result = measure(
+                    lambda: make_main2().generate_wave(mode, quality), repeat)
+                results.append(dict(workload=name, engine='main2', mode=mode,
+                                    quality=quality, **result))
+
+        full = {(r['engine'], r['mode']): r['wall_time']
+                for r in results[first:] if r['quality'] == 'full'}
+        for result in results[first:]:
+            key = (result['engine'], result['mode'])
+            if result['quality'] != 'full' and key in full:
+                result['speedup'] = full[key] / result['wall_time']
+
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'quick': quick,
+        'qualities': list(qualities),
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='2つの描画エンジンの速度とメモリを計測する')
+    parser.add_argument('workloads', nargs='*',
+                        help='計測する曲(省略時は全て): {}'.format(
+                            ', '.join(workloads(quick=True))))
+    parser.add_argument('-o', '--output', help='結果のJSONの出力先')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='実行時間を測る回数(最短の時間を報告する)')
+    parser.add_argument('--quick', action='store_true',
+                        help='合成曲を1/10の大きさにする')
+    parser.add_argument('--quality', nargs='+', choices=QUALITIES,
+                        default=['full'],
+                        help='計測する品質(デフォルト: full)．fullと一緒に'
+                             '指定するとfullに対する速度の比も出力する')
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.workloads, args.repeat, args.quick,
+                            args.quality)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""生成済みのndarrayを使い回すためのキャッシュ"""
+
+import collections
+import threading
+
+import numpy as np
+
+from oscillator import get_oscillator
+
+
+class ArrayCache(object):
+    """合計バイト数に上限をもつndarrayのLRUキャッシュ
+
+    登録した配列は書き込み禁止にしてそのまま返すので，呼び出し側は
+    コピーせずに読み出せる．書き換えたい場合は呼び出し側でコピーすること．
+    複数のスレッドから使ってよい(配列の生成はロックの外で行う)
+    max_bytes : 保持する配列の合計バイト数の上限
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._arrays = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._arrays)
+
+    def get(self, key, factory):
+        """keyに対応する配列を返す
+
+        キャッシュにない場合はfactory()で配列を作って登録する
+        """
+        array = self.lookup(key)
+        if array is not None:
+            return array
+
+        array = factory()
+        array.flags.writeable = False
+        with self._lock:
+            self.misses += 1
+            self._put(key, array)
+        return array
+
+    def lookup(self, key):
+        """keyに対応する配列を返す．キャッシュにない場合はNoneを返す"""
+        with self._lock:
+            array = self._arrays.get(key)
+            if array is not None:
+                self.hits += 1
+                self._arrays.move_to_end(key)  # 最近使ったものを末尾へ
+        return array
+
+    def clear(self):
+        with self._lock:
+            self._arrays.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """ヒット数，ミス数などの統計を辞書で返す"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': len(self._arrays),
+            'nbytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+        }
+
+    def _put(self, key, array):
+        if array.nbytes > self.max_bytes:
+            return  # 上限を超える配列はキャッシュしない
+
+        old_array = self._arrays.pop(key, None)  # 別のスレッドが先に登録した
+        if old_array is not None:
+            self.nbytes -= old_array.nbytes
+        self._arrays[key] = array
+        self.nbytes += array.nbytes
+        while self.nbytes > self.max_bytes:  # 古いものから捨てる
+            _, old_array = self._arrays.popitem(last=False)
+            self.nbytes -= old_array.nbytes
+
+
+class WaveCache(ArrayCache):
+    """音符の波形を(オシレータ, 周波数, サンプル数, サンプルレート)ごとに
+    保持するキャッシュ
+
+    同じ高さ・長さの音符が何度も出てくる曲で，波形の計算を省く．
+    サンプルレートが変わるとそれまでの波形は使われなくなるので全て捨てる
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        super().__init__(max_bytes)
+        self.rate = None
+
+    def wave(self, freq, n, rate, oscillator=None, dtype=np.float64):
+        """周波数freq，長さnの波形を返す(書き込み禁止)
+
+        oscillator : Oscillatorインスタンス．Noneならsin波
+        dtype : 波形の型
+        """
+        self._check_rate(rate)
+        oscillator = get_oscillator(oscillator)
+        return self.get((oscillator.key(), freq, n, rate, np.dtype(dtype)),
+                        lambda: oscillator.wave(freq, n, rate, dtype))
+
+    def chord(self, freqs, n, rate, oscillator=None, dtype=np.float64):
+        """周波数freqsの波形(長さn)の和を返す(書き込み禁止)"""
+        if len(freqs) == 1:
+            return self.wave(freqs[0], n, rate, oscillator, dtype)
+
+        self._check_rate(rate)
+        oscillator = get_oscillator(oscillator)
+        freqs = tuple(freqs)
+        return self.get((oscillator.key(), freqs, n, rate, np.dtype(dtype)),
+                        lambda: oscillator.chord(freqs, n, rate, dtype))
+
+    def _check_rate(self, rate):
+        if rate != self.rate:
+            self.clear()
+            self.rate = rate
+
+
+wave_cache = WaveCache()  # main.pyとmain2.pyで共有する
@@ -0,0 +1,118 @@
+"""MusicComponentの木を平らなイベント表にコンパイルしたもの
+
+木をたどる処理(調の合成，音名の解析，時間の計算)はコンパイル時に1度だけ行い，
+波形の生成はイベント表をまとめて処理するベクトル化した関数で行う
+"""
+
+import numpy as np
+
+from oscillator import get_oscillator
+from synth import MAX_BLOCK_BYTES
+
+
+EVENT_DTYPE = np.dtype([
+    ('start', np.int64),  # 開始位置(サンプル)
+    ('length', np.int64),  # 長さ(サンプル)
+    ('freq', np.float64),  # 周波数
+    ('amp', np.float64),  # 振幅
+    ('envelope', np.int32),  # envelopesの添字
+])
+
+
+class CompiledScore(object):
+    """音符のイベント表
+
+    拍単位の開始位置・長さを保持しておき，bpmとrateが変わった時は
+    eventsの整数の列(start, length)だけを計算し直す
+    開始位置は拍から直接サンプルに変換するので，前の音符の長さの端数を
+    切り捨てながら積み上げる木の描画とは数サンプルずれることがある
+    beat_start, beat_length : 各音符の開始位置と長さ(4分音符が1)
+    freq, amp : 各音符の周波数と振幅
+    envelope_ids : 各音符のエンベロープのenvelopesにおける添字
+    envelopes : Envelopeインスタンスのリスト
+    beat_total : 曲全体の長さ(末尾の休符を含む)
+    """
+
+    def __init__(self, beat_start, beat_length, freq, amp, envelope_ids,
+                 envelopes, beat_total, bpm, rate):
+        self.beat_start = np.asarray(beat_start, dtype=np.float64)
+        self.beat_length = np.asarray(beat_length, dtype=np.float64)
+        self.envelopes = list(envelopes)
+        self.beat_total = beat_total
+
+        self.events = np.zeros(len(self.beat_start), dtype=EVENT_DTYPE)
+        self.events['freq'] = freq
+        self.events['amp'] = amp
+        self.events['envelope'] = envelope_ids
+
+        self.bpm = None
+        self.rate = None
+        self.rescale(bpm, rate)
+
+    def __len__(self):
+        return len(self.events)
+
+    @classmethod
+    def from_events(cls, events, envelopes, beat_total, bpm, rate):
+        """(開始拍, 拍数, 周波数, 振幅, エンベロープ添字)のリストから作る"""
+        columns = list(zip(*events)) or [()] * 5
+        return cls(*columns, envelopes=envelopes, beat_total=beat_total,
+                   bpm=bpm, rate=rate)
+
+    def rescale(self, bpm, rate):
+        """bpmとrateに合わせて開始位置と長さの列だけを計算し直す"""
+        if (bpm, rate) == (self.bpm, self.rate):
+            return self
+
+        factor = (60 / bpm) * rate
+        self.events['start'] = self.beat_start * factor
+        self.events['length'] = self.beat_length * factor
+        self.bpm = bpm
+        self.rate = rate
+        return self
+
+    def sample_length(self):
+        """曲全体のサンプル数"""
+        total = int(self.beat_total * (60 / self.bpm) * self.rate)
+        if len(self.events):
+            ends = self.events['start'] + self.events['length']
+            total = max(total, int(ends.max()))
+        return total
+
+    def render(self, out=None, oscillator=None, dtype=np.float64):
+        """イベント表から曲全体の波形を生成する
+
+        同じ長さ・エンベロープの音符をまとめ，周波数×時間の2次元配列で
+        一度に波形を計算してoutに足し込む
+        out : 波形を足し込むndarray．Noneなら新しく確保する
+        oscillator : 音符の波形を作るOscillatorインスタンス．Noneならsin波
+        dtype : outを新しく確保する時の型．outを渡した場合はその型で計算する
+        """
+        oscillator = get_oscillator(oscillator)
+        if out is None:
+            out = np.zeros(self.sample_length(), dtype=dtype)
+
+        events = self.events
+        keys = np.stack([events['length'], events['envelope']], axis=1)
+        for length, envelope_id in np.unique(keys, axis=0).tolist():
+            if length <= 0:
+                continue
+            mask = ((events['length'] == length) &
+                    (events['envelope'] == envelope_id))
+            self._render_group(out, events[mask], length,
+                               self.envelopes[envelope_id], oscillator)
+        return out
+
+    def _render_group(self, out, group, length, envelope, oscillator):
+        """同じ長さ・エンベロープをもつ音符をまとめて描く"""
+        envelope_wave = envelope.get(length, out.dtype)
+
+        rows = max(1, MAX_BLOCK_BYTES // (length * 8))
+        for first in range(0, len(group), rows):
+            chunk = group[first:first + rows]
+            block = oscillator.waves(chunk['freq'], length, self.rate,
+                                     out.dtype)
+            block *= envelope_wave
+            block *= chunk['amp'][:, np.newaxis].astype(out.dtype)
+            for start, wave in zip(chunk['start'].tolist(), block):
+                out[start:start + length] += wave
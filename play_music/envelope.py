@@ -0,0 +1,122 @@
+"""音の立ち上がりと減衰を表すエンベロープ
+
+Envelopeは長さnの係数配列を生成し，音符の波形に掛けて音を滑らかにする．
+生成した配列は種類・パラメータ・サンプル数をキーとしてenvelope_cacheに
+保持され，同じ長さの音符の間で使い回される．
+新しい形のエンベロープはEnvelopeを継承してparams()とgenerate()を実装する
+"""
+
+import numpy as np
+
+from cache import ArrayCache
+
+
+envelope_cache = ArrayCache(max_bytes=16 * 1024 * 1024)
+
+
+class Envelope(object):
+    """エンベロープの抽象クラス"""
+
+    def params(self):
+        """形を決めるパラメータのタプルを返す．キャッシュのキーに使う"""
+        raise NotImplementedError
+
+    def generate(self, n):
+        """長さnの係数配列を新しく生成する"""
+        raise NotImplementedError
+
+    def key(self, n, dtype=np.float64):
+        return (self.__class__, self.params(), n, np.dtype(dtype))
+
+    def get(self, n, dtype=np.float64, cache=None):
+        """長さnの係数配列を返す
+
+        cacheに同じ形・長さ・型の配列があればそれを返す(書き込み禁止)
+        """
+        if cache is None:
+            cache = envelope_cache
+        return cache.get(self.key(n, dtype),
+                         lambda: self.generate(n).astype(dtype, copy=False))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.params() == other.params()
+
+    def __hash__(self):
+        return hash((self.__class__, self.params()))
+
+    def __repr__(self):
+        return '{}{}'.format(self.__class__.__name__, self.params())
+
+
+class LognormEnvelope(Envelope):
+    """対数正規分布の確率密度関数の形をしたエンベロープ
+
+    s : 対数正規分布の形状パラメータ
+    """
+
+    def __init__(self, s=1.5):
+        self.s = s
+
+    def params(self):
+        return (self.s,)
+
+    def generate(self, n):
+        import scipy.stats  # 他のエンベロープだけを使う場合はscipy不要
+
+        rv = scipy.stats.lognorm(self.s)
+        return rv.pdf(np.linspace(0, 1, n))
+
+
+class ADSREnvelope(Envelope):
+    """Attack，Decay，Sustain，Releaseの4区間の折れ線エンベロープ
+
+    attack, decay, release : 各区間の長さ．音の長さに対する割合
+    sustain : 持続区間の音量．peakに対する割合
+    peak : attack終了時の音量
+    """
+
+    def __init__(self, attack=0.05, decay=0.1, sustain=0.7, release=0.2,
+                 peak=1.0):
+        self.attack = attack
+        self.decay = decay
+        self.sustain = sustain
+        self.release = release
+        self.peak = peak
+
+    def params(self):
+        return (self.attack, self.decay, self.sustain, self.release,
+                self.peak)
+
+    def generate(self, n):
+        attack_end = min(self.attack, 1)
+        decay_end = min(attack_end + self.decay, 1)
+        release_start = max(1 - self.release, decay_end)
+
+        xp = [0, attack_end, decay_end, release_start, 1]
+        fp = [0, self.peak, self.peak * self.sustain,
+              self.peak * self.sustain, 0]
+        return np.interp(np.linspace(0, 1, n), xp, fp)
+
+
+class ExponentialDecayEnvelope(Envelope):
+    """鳴らした瞬間が最大で指数関数的に減衰するエンベロープ
+
+    decay : 減衰の速さ．音の終わりでpeak * exp(-decay)になる
+    peak : 音の始まりの音量
+    """
+
+    def __init__(self, decay=5.0, peak=1.0):
+        self.decay = decay
+        self.peak = peak
+
+    def params(self):
+        return (self.decay, self.peak)
+
+    def generate(self, n):
+        envelope = np.linspace(0, -self.decay, n)
+        np.exp(envelope, out=envelope)
+        envelope *= self.peak
+        return envelope
+
+
+DEFAULT_ENVELOPE = LognormEnvelope(1.5)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""MusicComponentの波形生成にかかる時間を要素ごとに計測する仕組み
+
+Profilerを有効にしている間だけMusicComponentの各クラスの
+generate_wave()とrender_into()を計測用の関数に差し替える．
+無効の時は元の関数のままなので，計測しない時のコストはない
+
+例:
+    with Profiler() as profiler:
+        music.generate_wave(mode='recursive')
+    print(profiler.report())
+    profiler.write_folded('canon.folded')  # flamegraph.pl等に渡せる形式
+
+    python instrument.py canon --mode recursive --folded canon.folded
+"""
+
+import argparse
+import inspect
+import threading
+import time
+import tracemalloc
+
+import main2
+
+
+HOOKED_METHODS = ('generate_wave', 'render_into')
+
+
+class ProfileNode(object):
+    """1回のgenerate_wave()またはrender_into()の呼び出しの計測結果
+
+    label : 要素を表す文字列 ("Series[12]", "Note(c4)" など)
+    method : 呼び出された関数名
+    seconds : 子の呼び出しを含む経過時間
+    samples : 生成(または足し込み)したサンプル数
+    nbytes : 確保したバイト数．tracemallocが有効ならその増分，
+             無効ならgenerate_wave()が返した配列の大きさ
+    """
+
+    def __init__(self, label, method):
+        self.label = label
+        self.method = method
+        self.seconds = 0.0
+        self.samples = 0
+        self.nbytes = 0
+        self.children = []
+
+    @property
+    def self_seconds(self):
+        """子の呼び出しを除いた経過時間"""
+        return max(self.seconds - sum(c.seconds for c in self.children), 0.0)
+
+    def walk(self, stack=()):
+        """(ラベルの並び, ノード)を深さ優先で列挙する"""
+        stack = stack + (self.label,)
+        yield stack, self
+        for child in self.children:
+            yield from child.walk(stack)
+
+
+def component_label(component):
+    """flamegraphのスタックに使える要素のラベルを返す"""
+    name = type(component).__name__
+    if isinstance(component, main2.Note):
+        return '{}({})'.format(name, component.scale)
+    components = getattr(component, 'components', None)
+    if components is not None:
+        return '{}[{}]'.format(name, len(components))
+    return name
+
+
+class Profiler(object):
+    """MusicComponentの木の要素ごとの計測を行うクラス
+
+    with文の中(またはstart()からstop()まで)で呼ばれた波形生成を
+    呼び出しの木として記録する．並列に描いたChordの要素は
+    別プロセスで描かれるので記録されない
+    trace_memory : Trueならtracemallocで確保したバイト数を測る(遅くなる)
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.roots = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._originals = []
+        self._started_tracemalloc = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def active(self):
+        return bool(self._originals)
+
+    def start(self):
+        """計測用の関数に差し替える"""
+        if self.active:
+            raise RuntimeError('profiler is already active')
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+
+        for cls in _component_classes():
+            for name in HOOKED_METHODS:
+                method = cls.__dict__.get(name)
+                if method is None:  # 親クラスの関数は親で差し替える
+                    continue
+                self._originals.append((cls, name, method))
+                setattr(cls, name, self._hook(name, method))
+
+    def stop(self):
+        """元の関数に戻す"""
+        for cls, name, method in reversed(self._originals):
+            setattr(cls, name, method)
+        self._originals = []
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def clear(self):
+        self.roots = []
+
+    def _hook(self, name, method):
+        signature = inspect.signature(method)
+        profiler = self
+
+        def hooked(component, *args, **kwargs):
+            node = ProfileNode(component_label(component), name)
+            stack = profiler._stack()
+            if stack:
+                stack[-1].children.append(node)
+            else:
+                with profiler._lock:
+                    profiler.roots.append(node)
+
+            stack.append(node)
+            memory = tracemalloc.get_traced_memory()[0] \
+                if tracemalloc.is_tracing() else None
+            begin = time.perf_counter()
+            try:
+                result = method(component, *args, **kwargs)
+            finally:
+                node.seconds = time.perf_counter() - begin
+                stack.pop()
+
+            if name == 'generate_wave':
+                node.samples = len(result)
+                node.nbytes = result.nbytes
+            else:
+                arguments = signature.bind(component, *args, **kwargs)
+                node.samples = _written_samples(component, arguments)
+            if memory is not None:
+                node.nbytes = max(
+                    tracemalloc.get_traced_memory()[0] - memory, 0)
+            return result
+
+        hooked.__name__ = method.__name__
+        hooked.__doc__ = method.__doc__
+        hooked.__wrapped__ = method
+        return hooked
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def report(self, max_depth=None, min_fraction=0.0):
+        """計測結果を木の形の文字列にする
+
+        max_depth : これより深い要素は表示しない
+        min_fraction : 全体の時間に対する割合がこれ未満の要素は表示しない
+        """
+        total = sum(root.seconds for root in self.roots) or 1.0
+        lines = ['{:>10} {:>10} {:>6} {:>10} {:>12}  {}'.format(
+            'total[ms]', 'self[ms]', '%', 'samples', 'bytes', 'component')]
+        for root in self.roots:
+            for stack, node in root.walk():
+                depth = len(stack) - 1
+                if max_depth is not None and depth > max_depth:
+                    continue
+                if node.seconds / total < min_fraction:
+                    continue
+                lines.append('{:10.3f} {:10.3f} {:6.1f} {:10d} {:12d}  '
+                             '{}{}.{}'.format(
+                                 node.seconds * 1e3, node.self_seconds * 1e3,
+                                 100 * node.seconds / total, node.samples,
+                                 node.nbytes, '  ' * depth, node.label,
+                                 node.method))
+        return '\n'.join(lines)
+
+    def folded(self):
+        """flamegraphの入力形式(folded stacks)の行を返す
+
+        各行は"ラベル;ラベル;... 子を除いた時間[μs]"で，同じスタックは
+        1行にまとめる
+        """
+        totals = {}
+        for root in self.roots:
+            for stack, node in root.walk():
+                key = ';'.join(stack)
+                totals[key] = totals.get(key, 0.0) + node.self_seconds
+        return ['{} {}'.format(key, int(round(seconds * 1e6)))
+                for key, seconds in totals.items()]
+
+    def write_folded(self, path):
+        with open(path, 'w') as f:
+            for line in self.folded():
+                f.write(line + '\n')
+
+
+def _component_classes(cls=main2.MusicComponent):
+    """MusicComponentとその全てのサブクラスを列挙する"""
+    yield cls
+    for subclass in cls.__subclasses__():
+        yield from _component_classes(subclass)
+
+
+def _written_samples(component, arguments):
+    """render_into()がoutに足し込んだサンプル数を求める"""
+    values = arguments.arguments
+    start = values.get('start', 0)
+    n = component.sample_length(values['bpm'], values['rate'])
+    return max(min(len(values['out']), n - start), 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='曲の波形生成を要素ごとに計測する')
+    parser.add_argument('score', help='main2.pyの曲の関数名(canonなど)')
+    parser.add_argument('--mode', default='recursive',
+                        choices=('inplace', 'recursive'))
+    parser.add_argument('--depth', type=int, default=None,
+                        help='表示する木の深さ')
+    parser.add_argument('--min-fraction', type=float, default=0.01,
+                        help='全体に対する割合がこれ未満の要素は表示しない')
+    parser.add_argument('--folded', help='folded stacksを書き出すファイル')
+    parser.add_argument('--memory', action='store_true',
+                        help='tracemallocで確保したバイト数を測る')
+    args = parser.parse_args()
+
+    music = getattr(main2, args.score)()
+    with Profiler(trace_memory=args.memory) as profiler:
+        music.generate_wave(mode=args.mode)
+
+    print(profiler.report(args.depth, args.min_fraction))
+    if args.folded:
+        profiler.write_folded(args.folded)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""音符のイベントを受け取りながらブロックごとに鳴らすリアルタイムエンジン
+
+楽譜を先に全て生成するのではなく，note-on/note-offのイベントを
+キュー(またはローカルのUDPソケット)から受け取り，鳴っている音(ボイス)を
+ブロックごとに合成する．イベントの時刻はエンジンの時計(生成した
+サンプル数/サンプルレート)の秒で表し，ブロックの途中の時刻のイベントは
+そのサンプルの位置から鳴らす
+
+例:
+    engine = LiveEngine()
+    engine.note_on('c4')
+    engine.note_off('c4', at=engine.now() + 1)
+    engine.run(duration=2)
+
+    python live.py --port 9999 &
+    echo "on c4 0.8" | nc -u -w0 127.0.0.1 9999
+"""
+
+import argparse
+import collections
+import heapq
+import itertools
+import math
+import queue
+import socket
+import threading
+import time
+
+import numpy as np
+
+from oscillator import get_oscillator
+from pitch import BASE_KEY_FACTOR, frequency_table, parse_scale
+from stream import get_output
+
+
+BLOCK_SIZE = 256  # 1ブロックのサンプル数．小さいほど遅延が小さい
+MAX_VOICES = 16  # 同時に鳴らせる音の数
+LOOKAHEAD = 0.02  # 時刻を指定しないイベントを何秒先に予約するか
+STATS_BLOCKS = 1 << 16  # 統計に使う直近のブロック数
+
+
+class NoteEvent(object):
+    """note-onまたはnote-offのイベント
+
+    time : エンジンの時計での時刻(秒)
+    kind : 'on'または'off'
+    scale : 音名("c4"など)
+    velocity : note-onの音量(0から1)
+    """
+
+    def __init__(self, time, kind, scale, velocity=1.0):
+        if kind not in ('on', 'off'):
+            raise ValueError('unknown event kind: {!r}'.format(kind))
+        self.time = time
+        self.kind = kind
+        self.scale = scale
+        self.pitch = parse_scale(scale)
+        self.velocity = velocity
+
+    def __repr__(self):
+        return 'NoteEvent({!r}, {!r}, {!r}, {!r})'.format(
+            self.time, self.kind, self.scale, self.velocity)
+
+
+class Voice(object):
+    """鳴っている1つの音．位相とエンベロープの状態をブロックをまたいで保つ
+
+    エンベロープはattack秒でvelocityまで上がり，note-offからrelease秒で
+    0まで下がる直線
+    """
+
+    def __init__(self, pitch, freq, velocity, started, attack, release,
+                 rate):
+        self.pitch = pitch
+        self.freq = freq
+        self.velocity = velocity
+        self.started = started  # 鳴り始めたサンプル位置(ボイスを奪う順)
+        self.release = release
+        self.rate = rate
+        self.phase = 0.0
+        self.level = 0.0
+        self.target = velocity
+        self.slope = velocity / max(attack * rate, 1)
+        self.released = False
+        self.stolen = False
+
+    @property
+    def finished(self):
+        return self.released and self.level <= 0.0
+
+    def note_off(self):
+        self.released = True
+        self.target = 0.0
+        self.slope = -self.level / max(self.release * self.rate, 1)
+
+    def steal(self):
+        """別の音に使うために，2ミリ秒で素早く消す"""
+        self.released = True
+        self.stolen = True
+        self.target = 0.0
+        self.slope = -self.level / max(0.002 * self.rate, 1)
+
+    def render_into(self, out, oscillator):
+        """長さlen(out)の波形をoutに足す"""
+        n = len(out)
+        wave, self.phase = oscillator.render(self.freq, n, self.rate,
+                                             self.phase, out.dtype)
+        gain = self.level + self.slope * np.arange(1, n + 1, dtype=out.dtype)
+        if self.slope >= 0:
+            np.minimum(gain, self.target, out=gain)
+        else:
+            np.maximum(gain, self.target, out=gain)
+        wave *= gain
+        out += wave
+        self.level = float(gain[-1])
+
+
+class LiveEngine(object):
+    """イベントに従ってボイスを合成し，ブロックを次々に作るエンジン
+
+    rate : サンプルレート
+    block_size : 1ブロックのサンプル数．1ブロックの締め切りは
+                 block_size / rate秒
+    max_voices : 同時に鳴らせる音の数．超えた時は解放中の音，なければ
+                 最も古い音を奪う
+    lookahead : 時刻を指定せずに送ったイベントを何秒先に予約するか．
+                生成がこれだけ先行していれば，イベントはサンプル単位の
+                正確な位置で鳴る
+    oscillator : Oscillatorインスタンスまたはその名前
+    volume : 全体の音量
+    """
+
+    def __init__(self, rate=44100, block_size=BLOCK_SIZE,
+                 max_voices=MAX_VOICES, lookahead=LOOKAHEAD,
+                 oscillator=None, volume=0.1, attack=0.005, release=0.05,
+                 dtype=np.float32):
+        self.rate = rate
+        self.block_size = block_size
+        self.max_voices = max_voices
+        self.lookahead = lookahead
+        self.oscillator = get_oscillator(oscillator)
+        self.volume = volume
+        self.attack = attack
+        self.release = release
+        self.dtype = np.dtype(dtype)
+        self.events = queue.Queue()  # 他のスレッドからNoteEventを入れる
+        self.position = 0  # 次に生成するサンプルの位置
+        self.voices = []
+        self._pending = []  # 時刻順のイベントのヒープ
+        self._order = itertools.count()  # 同じ時刻のイベントは届いた順
+        self._table = frequency_table(BASE_KEY_FACTOR)
+        self._stopped = threading.Event()
+        self._render_times = collections.deque(maxlen=STATS_BLOCKS)
+        self.blocks = 0
+        self.late_events = 0
+        self.stolen_voices = 0
+
+    # イベントの受け取り
+    def now(self):
+        """エンジンの時計での現在の時刻(秒)"""
+        return self.position / self.rate
+
+    def send(self, event):
+        """イベントを送る．どのスレッドから呼んでもよい"""
+        self.events.put(event)
+
+    def note_on(self, scale, velocity=1.0, at=None):
+        """atの時刻(省略時はlookahead秒後)に音を鳴らし始める"""
+        at = self.now() + self.lookahead if at is None else at
+        self.send(NoteEvent(at, 'on', scale, velocity))
+
+    def note_off(self, scale, at=None):
+        """atの時刻(省略時はlookahead秒後)に音を止める"""
+        at = self.now() + self.lookahead if at is None else at
+        self.send(NoteEvent(at, 'off', scale))
+
+    # ブロックの生成
+    def _receive(self):
+        """キューに届いたイベントを時刻順のヒープに移す"""
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                return
+            position = int(round(event.time * self.rate))
+            heapq.heappush(self._pending,
+                           (position, next(self._order), event))
+
+    def _apply(self, event):
+        if event.kind == 'off':
+            for voice in self.voices:
+                if voice.pitch == event.pitch and not voice.released:
+                    voice.note_off()
+            return
+
+        active = [voice for voice in self.voices
+                  if not voice.stolen and not voice.finished]
+        if len(active) >= self.max_voices:  # 解放中の音，次に古い音から奪う
+            victim = min(active, key=lambda v: (not v.released, v.started))
+            victim.steal()
+            self.stolen_voices += 1
+        self.voices.append(Voice(
+            event.pitch, self._table[event.pitch], event.velocity,
+            self.position, self.attack, self.release, self.rate))
+
+    def render_block(self):
+        """次のblock_sizeサンプルを生成して返す
+
+        ブロックの途中の時刻のイベントはその位置でブロックを区切って
+        反映する．時刻を過ぎてから届いたイベントはブロックの先頭で反映し，
+        late_eventsに数える
+        """
+        begin = time.perf_counter()
+        self._receive()
+        out = np.zeros(self.block_size, dtype=self.dtype)
+        start = self.position
+        end = start + self.block_size
+        cursor = start
+        while cursor < end:
+            while self._pending and self._pending[0][0] <= cursor:
+                position, _, event = heapq.heappop(self._pending)
+                if position < start:
+                    self.late_events += 1
+                self._apply(event)
+            stop = min(self._pending[0][0], end) if self._pending else end
+            segment = out[cursor - start:stop - start]
+            for voice in self.voices:
+                voice.render_into(segment, self.oscillator)
+            self.position = cursor = stop
+        self.voices = [voice for voice in self.voices if not voice.finished]
+        out *= self.volume
+        self._render_times.append(time.perf_counter() - begin)
+        self.blocks += 1
+        return out
+
+    def iter_blocks(self, duration=None):
+        """stop()されるまで(またはduration秒分)ブロックを生成し続ける"""
+        end = None if duration is None else \
+            self.position + int(duration * self.rate)
+        while not self._stopped.is_set():
+            if end is not None and self.position >= end:
+                return
+            yield self.render_block()
+
+    def run(self, duration=None, output=None, buffer_blocks=2):
+        """共有の出力ストリームでブロックを鳴らし続ける
+
+        出力への書き込みが生成の速さを決めるので，エンジンの時計は
+        再生よりbuffer_blocksブロック分だけ先に進む
+        output : AudioOutputインスタンス．Noneなら共有のもの
+        """
+        output = output or get_output()
+        output.play_blocks(self.iter_blocks(duration), self.rate,
+                           block_size=self.block_size,
+                           buffer_blocks=buffer_blocks)
+
+    def stop(self):
+        self._stopped.set()
+
+    # 締め切りの統計
+    @property
+    def deadline(self):
+        """1ブロックを生成しなければならない時間(秒)"""
+        return self.block_size / self.rate
+
+    def stats(self):
+        """ブロックごとの生成時間と締め切りの統計を辞書で返す
+
+        時間の統計は直近のSTATS_BLOCKSブロックから求める
+        recommended_buffer_blocks : 最も遅かったブロックでも途切れない
+                                    ための先読みのブロック数
+        """
+        times = np.array(self._render_times)
+        if len(times) == 0:
+            times = np.zeros(1)
+        worst = float(times.max())
+        return {
+            'blocks': self.blocks,
+            'deadline': self.deadline,
+            'mean': float(times.mean()),
+            'p99': float(np.percentile(times, 99)),
+            'max': worst,
+            'load': float(times.mean()) / self.deadline,
+            'overruns': int((times > self.deadline).sum()),
+            'recommended_buffer_blocks': math.ceil(worst / self.deadline) + 1,
+            'late_events': self.late_events,
+            'stolen_voices': self.stolen_voices,
+        }
+
+
+def serve_udp(engine, host='127.0.0.1', port=9999):
+    """ローカルのUDPソケットで受け取った文字列をイベントとして送るスレッド
+
+    1つのデータグラムに"on c4 0.8"や"off c4"の形の行を書く．
+    時刻はエンジンのlookahead秒後になる．返したスレッドはデーモン
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((host, port))
+    sock.settimeout(0.1)
+
+    def receive():
+        while not engine._stopped.is_set():
+            try:
+                data, _ = sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            for line in data.decode().splitlines():
+                words = line.split()
+                try:
+                    if words[0] == 'on':
+                        velocity = float(words[2]) if len(words) > 2 else 1.0
+                        engine.note_on(words[1], velocity)
+                    elif words[0] == 'off':
+                        engine.note_off(words[1])
+                except (IndexError, ValueError) as e:
+                    print('ignored {!r}: {}'.format(line, e))
+        sock.close()
+
+    thread = threading.Thread(target=receive, daemon=True)
+    thread.start()
+    return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='UDPで受け取った音符のイベントをリアルタイムに鳴らす')
+    parser.add_argument('--port', type=int, default=9999)
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE)
+    parser.add_argument('--voices', type=int, default=MAX_VOICES)
+    parser.add_argument('--duration', type=float,
+                        help='鳴らし続ける秒数(省略時はCtrl-Cまで)')
+    args = parser.parse_args()
+
+    engine = LiveEngine(block_size=args.block_size, max_voices=args.voices)
+    serve_udp(engine, port=args.port)
+    try:
+        engine.run(args.duration)
+    except KeyboardInterrupt:
+        engine.stop()
+    for key, value in engine.stats().items():
+        print('{}: {}'.format(key, value))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 
-import math
-import re
+import asyncio
 
 import numpy as np
-import pyaudio
+
+from cache import wave_cache
+from mixer import Mixer
+from oscillator import get_oscillator
+from pitch import frequency_table, parse_scale
+from resample import render_rate, resample, resample_blocks
+from stream import BLOCK_SIZE, get_output
+from wavfile import MEMMAP_WINDOW, render_wav_memmap
 
 
 class MusicPart(object):
@@ -21,20 +27,59 @@ class MusicPart(object):
         'B': 2,
     }
 
-    def __init__(self, bpm=60, volume=0.1):
-        self._wave = np.empty(0)
+    INITIAL_CAPACITY = 1 << 16  # サンプルバッファの初期容量
+
+    def __init__(self, bpm=60, volume=0.1, oscillator=None,
+                 dtype=np.float64, pan=0.0, quality='full'):
+        """イニシャライザ
+
+        oscillator : 波形を作るOscillatorインスタンス，またはその名前
+                     ('sine', 'wavetable', 'square', 'saw', 'triangle')
+        dtype : 波形を生成・保持する型．np.float32にするとメモリが半分で済む
+        pan : ステレオのMusicで鳴らす時の位置．-1(左)から1(右)
+        quality : 'full'または'preview'．'preview'にすると音符を
+                  resample.PREVIEW_RATEで生成し，鳴らす時にRATEへ変換する．
+                  音符は追加した時に生成するので，ここで決める
+        """
+        # 書き込み位置(_length)より後ろは常に0で埋まっている
+        self.dtype = np.dtype(dtype)
+        self.render_rate = render_rate(self.__class__.RATE, quality)
+        self._buffer = np.zeros(self.__class__.INITIAL_CAPACITY,
+                                dtype=self.dtype)
+        self._length = 0
+        # 音のある範囲[start, end)のリスト．休符の範囲は含まない
+        self._segments = []
 
         self.bpm = bpm
         self.key_factor = self.__class__.BASE_KEY_FACTOR.copy()
         self.volume = volume
+        self.pan = pan
+        self.oscillator = get_oscillator(oscillator)
 
     # Private methods
 
-    def _generate_single_wave(self, freq, length=1):
-        step = (2 * math.pi) * freq / self.__class__.RATE  # 2πf*(1/rate)
-        single_wave = np.sin(step * np.arange(
-            int(length * (60 / self.bpm) * self.__class__.RATE)))  # sin(2πft)
-        return single_wave
+    @property
+    def _wave(self):
+        """これまでに書き込んだ波形(バッファのビュー)"""
+        self._reserve(self._length)  # 最後の休符の分はここで確保する
+        return self._buffer[:self._length]
+
+    def _add_segment(self, start, end):
+        """音のある範囲に[start, end)を加える．endは常に曲の終わり"""
+        while self._segments and self._segments[-1][1] >= start:
+            start = min(start, self._segments.pop()[0])  # 重なる範囲をまとめる
+        self._segments.append((start, end))
+
+    def _reserve(self, size):
+        """バッファの容量がsize以上になるよう倍々に拡張する"""
+        capacity = len(self._buffer)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        new_buffer = np.zeros(capacity, dtype=self.dtype)
+        new_buffer[:len(self._buffer)] = self._buffer  # 最後の休符は0のまま
+        self._buffer = new_buffer
 
     def _normalize_scale_argument(self, scales):
         """リストでない単一のscale入力をリスト化する．リストならそのまま
@@ -50,24 +95,9 @@ class MusicPart(object):
         """単一のscaleに対する周波数を返す
 
         例： "c#5" -> 554.365, "a5"-> 880.000
+        音名が不正な場合はpitch.InvalidScaleError(ValueError)を送出する
         """
-
-        # 正規表現で音階，変化記号，オクターブ番号を抽出
-        match = re.match(r'([a-gA-G])([b#]?)([0-9]+)$', scale)
-        if match is None:
-            raise Exception
-        key, accidental, octave_str = match.groups()
-
-        factor = self.key_factor[key.upper()]
-        octave = int(octave_str)
-
-        if accidental == '#':
-            factor += 1
-        elif accidental == 'b':
-            factor -= 1
-
-        freq = 440 * (2**((octave - 4) + factor / 12))
-        return freq
+        return frequency_table(self.key_factor)[parse_scale(scale)]
 
     # Public methods
     def rest(self, length=1):
@@ -75,9 +105,8 @@ class MusicPart(object):
 
         length: 休符の長さ．4分休符が1
         """
-        zero_wave = np.zeros(
-            int(length * (60 / self.bpm) * self.__class__.RATE))
-        self._wave = np.concatenate((self._wave, zero_wave))
+        size = int(length * (60 / self.bpm) * self.render_rate)
+        self._length += size  # カーソルより後ろは0なので進めるだけでよい
 
     def append_tone(self, scales, length=1, backward=False):
         """音符を追加する
@@ -91,27 +120,51 @@ class MusicPart(object):
         backward=Trueの時，length分前から，前の音符にかぶせて音符をならす
         """
 
-        waves = []
-
+        # 波形を書き込む前に全ての音名を解析して，不正な音名はここで弾く
         scale_list = self._normalize_scale_argument(scales)
-        for scale in scale_list:  # 音階ごとのsin波を順にwavesに追加する
-            freq = self._freq_from_scale(scale)
-            single_wave = self._generate_single_wave(freq, length)
-            waves.append(single_wave)
+        freqs = [self._freq_from_scale(scale) for scale in scale_list]
 
-        new_wave = np.sum(waves, axis=0)  # 音の波形をすべて足す
+        # 音階ごとの波形をまとめて計算して足す(書き込み禁止の配列)
+        rate = self.render_rate
+        new_wave = wave_cache.chord(
+            freqs, int(length * (60 / self.bpm) * rate), rate, self.oscillator,
+            self.dtype)
         if backward:
             back_length = len(new_wave)
             self._wave[-back_length:] += new_wave
+            self._add_segment(max(self._length - back_length, 0),
+                              self._length)
         else:
-            self._wave = np.concatenate((self._wave, new_wave))
+            end = self._length + len(new_wave)
+            self._reserve(end)
+            self._buffer[self._length:end] = new_wave
+            self._add_segment(self._length, end)
+            self._length = end
+
+    def iter_blocks(self, block_size=BLOCK_SIZE):
+        """get_wave()と同じ波形をblock_sizeサンプルずつ返すジェネレータ"""
+        size = max(block_size * self.render_rate // self.__class__.RATE, 1)
+        blocks = (self._wave[start:start + size] * self.volume
+                  for start in range(0, self._length, size))
+        return resample_blocks(blocks, self.render_rate, self.__class__.RATE)
+
+    def play(self, stream=True, block_size=BLOCK_SIZE, wait=True):
+        """パートを鳴らす
+
+        開いたままの共有の出力ストリーム(stream.get_output())の再生待ちの
+        列に入れる．stream=Trueの時はブロックごとに渡しながら再生する
+        wait : Falseなら鳴らし終えるのを待たずにFutureを返す
+        """
+        blocks = self.iter_blocks(block_size) if stream else [self.get_wave()]
+        future = get_output().submit(blocks, self.__class__.RATE,
+                                     block_size=block_size)
+        if wait:
+            future.result()
+        return future
 
-    def play(self):
-        pa = pyaudio.PyAudio()
-        stream = pa.open(format=pyaudio.paFloat32, channels=1,
-                         rate=self.__class__.RATE, output=True)
-        out_wave = self.get_wave()
-        stream.write(out_wave.astype(np.float32).tostring())
+    async def play_async(self, stream=True, block_size=BLOCK_SIZE):
+        """パートを鳴らすコルーチン"""
+        await asyncio.wrap_future(self.play(stream, block_size, wait=False))
 
     def change_key(self, scales, signature):
         """調を変更する
@@ -134,7 +187,9 @@ class MusicPart(object):
 
     # getter
     def get_wave(self):
-        return self._wave * self.volume
+        """音量を掛けたRATEの波形を返す"""
+        return resample(self._wave * self.volume, self.render_rate,
+                        self.__class__.RATE)
 
 
 class Music(object):
@@ -144,50 +199,102 @@ class Music(object):
     add_part(part)でパートを追加したあとで，play()で鳴らせる
     """
 
-    def __init__(self, main_volume=1):
+    def __init__(self, main_volume=1, dtype=np.float64, channels=1,
+                 limiter=None):
+        """イニシャライザ
+
+        dtype : パートを合成する型
+        channels : 2にするとパートのpanに従ってステレオで鳴らす
+        limiter : None, 'soft'または'hard'．合成した波形の振幅を1以下に抑える
+        """
         self.parts = []
         self.main_volume = main_volume
+        self.dtype = np.dtype(dtype)
+        self.channels = channels
+        self.limiter = limiter
 
     # Private methods
-    def _marged_wave(self):
-        """Partごとの音を合成した波形を返す"""
-
-        wave = np.empty(1)
+    @property
+    def _render_rate(self):
+        """パートの波形のサンプルレート．全てのパートで同じであること"""
+        rates = {part.render_rate for part in self.parts}
+        if len(rates) > 1:
+            raise ValueError('parts have different qualities')
+        return rates.pop() if rates else MusicPart.RATE
+
+    def _mixer(self):
+        """パートを登録したMixerを返す"""
+        mixer = Mixer(self.channels, self.main_volume, self.limiter,
+                      dtype=self.dtype)
         for part in self.parts:
-            wave = self._marge(wave, part.get_wave())
-        return wave
-
-    def _marge(self, wave1, wave2):
-        """2つの波形を合成する"""
-
-        if len(wave1) < len(wave2):
-            long_wave = wave2.copy()
-            short_wave = wave1
-        else:
-            long_wave = wave1.copy()
-            short_wave = wave2
-        long_wave[:len(short_wave)] += short_wave
-        return long_wave
+            mixer.add(part._wave, part.volume, part.pan, part._segments)
+        return mixer
 
     # Public methods
     def add_part(self, part):
         self.parts.append(part)
 
-    def play(self):
-        out_wave = self._marged_wave() * self.main_volume
+    def mix(self):
+        """パートを合成した曲全体の波形を返す"""
+        return resample(self._mixer().mix(), self._render_rate,
+                        MusicPart.RATE)
+
+    def iter_blocks(self, block_size=BLOCK_SIZE):
+        """パートを合成した波形をblock_sizeサンプルずつ返すジェネレータ
+
+        曲全体を合成せず，ブロックごとに各パートの対応する範囲を足し合わせる
+        """
+        rate = self._render_rate
+        mixer = self._mixer()
+        total = len(mixer)
+        size = max(block_size * rate // MusicPart.RATE, 1)
+
+        def blocks():
+            for start in range(0, total, size):
+                shape = (min(size, total - start),)
+                if self.channels == 2:
+                    shape += (2,)
+                yield mixer.mix(np.zeros(shape, dtype=self.dtype), start)
+
+        return resample_blocks(blocks(), rate, MusicPart.RATE)
+
+    def render_to_file(self, path, window=MEMMAP_WINDOW):
+        """曲を32ビット浮動小数点のWAVファイルへ書き出す
+
+        ファイルをnp.memmapでwindowサンプルずつ割り当て，各パートの波形を
+        その中で直接足し合わせるので，合成した曲全体の波形は作らない．
+        パートのqualityが'preview'ならそのサンプルレートのまま書き出す．
+        書き出したサンプル数を返す
+        """
+        mixer = self._mixer()
+        return render_wav_memmap(path, self._render_rate, len(mixer),
+                                 mixer.mix, window, self.channels)
+
+    def play(self, stream=True, block_size=BLOCK_SIZE, wait=True):
+        """曲を鳴らす
+
+        開いたままの共有の出力ストリーム(stream.get_output())の再生待ちの
+        列に入れる．stream=Trueの時はブロックごとに合成しながら再生する
+        wait : Falseなら鳴らし終えるのを待たずにFutureを返す
+        """
+        blocks = self.iter_blocks(block_size) if stream else [self.mix()]
+        future = get_output().submit(blocks, MusicPart.RATE, self.channels,
+                                     block_size=block_size)
+        if wait:
+            future.result()
+        return future
 
-        pa = pyaudio.PyAudio()
-        stream = pa.open(format=pyaudio.paFloat32, channels=1,
-                         rate=MusicPart.RATE, output=True)
-        stream.write(out_wave.astype(np.float32).tostring())
+    async def play_async(self, stream=True, block_size=BLOCK_SIZE):
+        """曲を鳴らすコルーチン"""
+        await asyncio.wrap_future(self.play(stream, block_size, wait=False))
 
 
-def amazing_grace():
+def amazing_grace(quality='full'):
     """Amazing GraceのMusicインスタンスを作成する関数"""
 
     bpm = 60
 
-    part = MusicPart(bpm=bpm)
+    part = MusicPart(bpm=bpm, quality=quality)
     part.change_key('F', '#')
 
     part.append_tone(['d4', 'b3'])
@@ -205,15 +312,15 @@ def amazing_grace():
     return part
 
 
-def canon():
+def canon(quality='full'):
     """パッヘルベルのカノンのMusicインスタンスを作成する関数"""
 
     bpm = 90
 
-    treble_part = MusicPart(bpm=bpm)
+    treble_part = MusicPart(bpm=bpm, quality=quality)
     treble_part.change_key(['C', 'F'], '#')
 
-    bass_part = MusicPart(bpm=bpm)
+    bass_part = MusicPart(bpm=bpm, quality=quality)
     bass_part.change_key(['A', 'E'], '#')
 
     # treble part
@@ -273,12 +380,12 @@ def canon():
     return music
 
 
-def jupiter():
+def jupiter(quality='full'):
     """JupiterのMusicインスタンスを作成する関数"""
 
     bpm = 90
 
-    part = MusicPart(bpm=bpm)
+    part = MusicPart(bpm=bpm, quality=quality)
     part.change_key(['A', 'B', 'E'], 'b')
 
     part.append_tone('g3', .5)
@@ -307,9 +414,10 @@ def jupiter():
 
 
 def main():
-    amazing_grace().play()
-    jupiter().play()
-    canon().play()
+    # 続けて再生待ちの列に入れると，曲間を空けずに鳴らせる
+    for music in (amazing_grace(), jupiter(), canon()):
+        future = music.play(wait=False)
+    future.result()
 
 
 if __name__ == '__main__':
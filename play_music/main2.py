@@ -1,12 +1,25 @@
 #!/usr/bin/env python3
 
+import asyncio
+import bisect
+import collections.abc
 import functools
-import math
-import re
-import scipy.stats
+import heapq
+import itertools
+import threading
+import weakref
 
 import numpy as np
-import pyaudio
+
+from cache import ArrayCache, wave_cache
+from compiled import CompiledScore
+from envelope import DEFAULT_ENVELOPE
+from oscillator import get_oscillator
+from parallel import render_parallel, should_parallelize
+from pitch import InvalidScaleError, LETTERS, frequency_table, parse_scale
+from resample import render_rate, resample, resample_blocks
+from stream import BLOCK_SIZE, get_output
+from wavfile import MEMMAP_WINDOW, render_wav_memmap
 
 
 def merge_waves(waves):
@@ -37,9 +50,12 @@ def normalize_scale_argument(scales):
         return scales
 
 
-class KeyConfig(dict):
-    """長調，単調などの調の変更を管理するクラス
+class KeyConfig(collections.abc.Mapping):
+    """長調，単調などの調を表す変更不可能なクラス
 
+    音階ごとの変更値(シャープなら+1，フラットなら-1)を値にもつMappingとして
+    振る舞う．同じ変更値のKeyConfigは1つのインスタンスを共有するので，
+    ハッシュ可能で，merge()の結果や周波数表も使い回せる
     """
 
     BASE_KEY_FACTOR = {  # ラの音を基準にしたときの半音の隔たり
@@ -62,22 +78,81 @@ class KeyConfig(dict):
         'B': 0,
     }
 
-    def __init__(self, scales=None, signature=None):
-        """イニシャライザ
+    __slots__ = ('_changes', '_factors', '_semitones', '_frequency_table')
+    _instances = {}  # 変更値のタプル -> KeyConfig
+    _INDEX = {key: i for i, key in enumerate(LETTERS)}  # 音階 -> 番号
 
-        scalesとsignatureを両方入力した場合はchange_key()が呼ばれる
+    def __new__(cls, scales=None, signature=None):
+        """コンストラクタ
+
+        scalesとsignatureを両方入力した場合はその調号をつけた調を返す
+        例:
+        変ホ長調：KeyConfig(['A', 'B', 'E'], 'b')
+        ト長調  ：KeyConfig('F', '#')
         """
-        super().__init__()
-        self.update(self.__class__.BASE_KEY_CHANGE)
+        key_conf = cls._intern((0,) * len(LETTERS))
         if scales is not None and signature is not None:
-            self.change_key(scales, signature)
+            key_conf = key_conf.change_key(scales, signature)
+        return key_conf
+
+    @classmethod
+    def _intern(cls, changes):
+        """変更値のタプルchangesに対応する唯一のインスタンスを返す"""
+        key_conf = cls._instances.get(changes)
+        if key_conf is None:
+            key_conf = super().__new__(cls)
+            semitones = tuple(cls.BASE_KEY_FACTOR[key] + change
+                              for key, change in zip(LETTERS, changes))
+            object.__setattr__(key_conf, '_changes', changes)
+            object.__setattr__(key_conf, '_semitones', semitones)
+            object.__setattr__(key_conf, '_factors',
+                               dict(zip(LETTERS, semitones)))
+            object.__setattr__(key_conf, '_frequency_table', None)
+            key_conf = cls._instances.setdefault(changes, key_conf)
+        return key_conf
+
+    def __setattr__(self, name, value):
+        raise AttributeError('KeyConfig is immutable')
+
+    def __reduce__(self):
+        return (self.__class__._intern, (self._changes,))
+
+    def __getitem__(self, key):
+        return self._changes[self._INDEX[key]]  # 音階でなければKeyError
+
+    def __iter__(self):
+        return iter(LETTERS)
+
+    def __len__(self):
+        return len(LETTERS)
+
+    def __eq__(self, other):
+        if isinstance(other, KeyConfig):
+            return self._changes == other._changes
+        return super().__eq__(other)
+
+    def __hash__(self):
+        return hash(self._changes)
+
+    def __repr__(self):
+        return 'KeyConfig({})'.format(dict(self))
+
+    @property
+    def semitones(self):
+        """音階(C, D, ..., B)ごとの，ラの音を基準にした半音の隔たりのタプル
+
+        調号による変化を含む．波形のキャッシュのキーなどに使える
+        """
+        return self._semitones
 
     def change_key(self, scales, signature):
-        """調を変更する
+        """調号を加えたKeyConfigを返す．自身は変更しない
 
         例:
-        変ホ長調：change_key(['A', 'B', 'E'], 'b')
-        ト長調  ：change_key('F', '#')
+        変ホ長調：KeyConfig().change_key(['A', 'B', 'E'], 'b')
+        ト長調  ：KeyConfig().change_key('F', '#')
+        音階の大文字小文字は区別しない．音階でない場合は
+        pitch.InvalidScaleError(ValueError)を送出する
         """
         factor = 0
         if signature == '#':
@@ -85,9 +160,16 @@ class KeyConfig(dict):
         elif signature == 'b':
             factor = -1
 
-        scale_list = normalize_scale_argument(scales)
-        for scale in scale_list:
-            self[scale] += factor
+        changes = list(self._changes)
+        for scale in normalize_scale_argument(scales):
+            index = (self._INDEX.get(scale.upper())
+                     if isinstance(scale, str) else None)
+            if index is None:
+                raise InvalidScaleError(
+                    '音階として解釈できません: {!r} (例: "F", "b")'.format(
+                        scale))
+            changes[index] += factor
+        return self._intern(tuple(changes))
 
     def factor_for_key(self, key):
         """音階に対する周波数を返す
@@ -95,33 +177,269 @@ class KeyConfig(dict):
         調を変更している場合は調を変えた後の周波数を返す
         key : D3などの音名
         """
-        factor = self.__class__.BASE_KEY_FACTOR[key] + self[key]
-        return factor
+        return self._factors[key]
+
+    def frequency_table(self):
+        """この調の周波数表(音高コード -> 周波数)を返す"""
+        if self._frequency_table is None:
+            object.__setattr__(self, '_frequency_table',
+                               frequency_table(self._factors))
+        return self._frequency_table
 
     @classmethod
     def merge(cls, key_conf1, key_conf2):
-        """2つのKeyConfig関数を取ってそれを合計したKeyConfigを返す"""
+        """2つのKeyConfig関数を取ってそれを合計したKeyConfigを返す
+
+        結果はキャッシュするので，同じ組み合わせでは同じインスタンスを返す
+        """
+        if key_conf1 is None:
+            return key_conf2 or cls()
+        if key_conf2 is None:
+            return key_conf1
+        return _merge_key_confs(key_conf1, key_conf2)
 
-        key_conf1 = key_conf1 or KeyConfig()
-        key_conf2 = key_conf2 or KeyConfig()
 
-        new_key_conf = KeyConfig()
-        for key in new_key_conf.keys():
-            new_key_conf[key] += key_conf1[key] + key_conf2[key]
-        return new_key_conf
+@functools.lru_cache(maxsize=None)
+def _merge_key_confs(key_conf1, key_conf2):
+    changes = tuple(change1 + change2 for change1, change2
+                    in zip(key_conf1._changes, key_conf2._changes))
+    return key_conf1._intern(changes)
+
+
+# 構造が同じ部分木の波形を(構造の番号, 入力)ごとに共有するキャッシュ
+subtree_cache = ArrayCache(64 * 1024 * 1024)
+MAX_STRUCTURES = 1 << 16  # 番号を覚えておく構造の数
+_structures = collections.OrderedDict()  # 構造を表すタプル -> 構造の番号
+_structures_lock = threading.Lock()
+_structure_ids = itertools.count()
+
+
+def _structure_number(key):
+    """構造を表すタプルkeyの番号を返す
+
+    番号は最近使ったMAX_STRUCTURES個の構造だけ覚えておく．忘れた構造には
+    次に新しい番号を振るので，その波形を共有できなくなるだけで，違う構造が
+    同じ番号になることはない
+    """
+    with _structures_lock:
+        number = _structures.get(key)
+        if number is not None:
+            _structures.move_to_end(key)
+            return number
+        number = _structures[key] = next(_structure_ids)
+        while len(_structures) > MAX_STRUCTURES:
+            _structures.popitem(last=False)
+    return number
 
 
 class MusicComponent(object):
-    """generate_wave()関数をもつクラスの抽象クラス"""
+    """generate_wave()関数をもつクラスの抽象クラス
+
+    generate_wave()で生成した波形は構造(種類，音高，長さ，子の構造など)と
+    入力(bpm, rate, 調など)をキーとしてsubtree_cacheに覚えておき，同じ
+    構造・入力なら曲のどこにあってもそれを使う．add()などで要素を変更
+    したり公開の属性に代入したりすると，その要素と親の要素の構造だけが
+    変わるので，変更していない部分木の波形は次に生成する時にそのまま
+    使われる．覚えておく波形の合計はsubtree_cacheの上限までなので，
+    要素ごとに波形を持ち続けることはない．
+    componentsのリストを直接書き換えた場合はinvalidate()を呼ぶこと
+    """
 
-    def generate_wave(self, bpm, rate, key_conf):
+    _parents = ()  # この要素を含む要素へのweakref
+    _structure_id = None
+    _silent = None
+    _length = None  # (bpm, rate, サンプル数)
+    _shared = False  # 同じ構造が曲の中に2度以上現れた
+    _dirty = True  # 構造の番号などの求めた値を何も覚えていない
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name == 'components':
+            for component in value:
+                component._add_parent(self)
+        elif isinstance(value, MusicComponent):
+            value._add_parent(self)
+        if not name.startswith('_'):
+            self.invalidate()
+
+    def __getstate__(self):
+        """親と，構造の番号などの求めた値はpickleしない"""
+        state = self.__dict__.copy()
+        for name in ('_parents', '_structure_id', '_silent', '_length',
+                     '_shared', '_offsets', '_dirty'):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def _add_parent(self, parent):
+        if not self._parents:
+            self._parents = []
+        self._parents.append(weakref.ref(parent))
+
+    def invalidate(self):
+        """構造が変わったことをこの要素と親の要素に伝える
+
+        深い木でも再帰しないよう，親は明示的なスタックでたどる．
+        要素の値は子の値を求めてから覚えるので，何も覚えていない(_dirtyな)
+        親より上には伝える必要がなく，そこで止める．木を組み立てる間は
+        どの要素も何も覚えていないので，add()は木の深さによらず定数時間
+        """
+        stack = [self]
+        while stack:
+            component = stack.pop()
+            component._structure_id = None
+            component._silent = None
+            component._length = None
+            component._shared = False
+            component.__dict__.pop('_offsets', None)
+            component._dirty = True
+            for ref in component._parents:
+                parent = ref()
+                if parent is not None and not parent._dirty:
+                    stack.append(parent)
+
+    def generate_wave(self, bpm, rate, key_conf=None, oscillator=None,
+                      dtype=np.float64):
         """波形生成する関数
 
         bpm, rate, KeyConfigインスタンスからそのMusicComponentが表す音の
-        波形表現を生成する
+        波形表現を生成する．返す配列は書き込み禁止
         bpm : 一分間に４分音符が何回あるか
         rate : 波形のサンプルレート
         key_conf : 調を表すKeyConfigインスタンス
+        oscillator : 音符の波形を作るOscillatorインスタンス．Noneならsin波
+        dtype : 波形の型(np.float64またはnp.float32)
+        """
+        if self.silent:  # 無音は覚えずに，求められた時だけ0の配列を作る
+            return np.zeros(self.sample_length(bpm, rate), dtype=dtype)
+
+        inputs = (bpm, rate, key_conf, oscillator, np.dtype(dtype))
+        return subtree_cache.get(
+            (self.structure_id(), inputs),
+            lambda: self._generate_wave(bpm, rate, key_conf, oscillator,
+                                        dtype))
+
+    def _generate_wave(self, bpm, rate, key_conf, oscillator=None,
+                       dtype=np.float64):
+        """generate_wave()の実際の処理．サブクラスで実装する"""
+        raise NotImplementedError
+
+    @property
+    def silent(self):
+        """音を出さない(休符だけからなる)要素ならTrue
+
+        親の要素は無音の子の波形を作らずに位置だけ進めるので，休符は
+        メモリも計算も使わない
+        """
+        if self._silent is None:
+            self._silent = self._is_silent()
+            self._dirty = False
+        return self._silent
+
+    def _is_silent(self):
+        raise NotImplementedError
+
+    def structure_key(self):
+        """生成する波形を決める値のタプルを返す．サブクラスで実装する
+
+        子の要素はstructure_id()で表すので，タプルの比較は浅く済む
+        """
+        raise NotImplementedError
+
+    def structure_id(self):
+        """構造が同じ要素どうしで等しい番号を返す"""
+        if self._structure_id is None:
+            key = (type(self),) + self.structure_key()
+            self._structure_id = _structure_number(key)
+            self._dirty = False
+        return self._structure_id
+
+    def sample_length(self, bpm, rate):
+        """generate_wave()が生成する波形のサンプル数を返す
+
+        bpmとrateごとに1度だけ求めて覚えておくので，ブロックごとに
+        render_into()を呼んでも子の長さを数え直さない
+        """
+        length = self._length
+        if length is None or length[:2] != (bpm, rate):
+            length = self._length = (bpm, rate,
+                                     self._sample_length(bpm, rate))
+            self._dirty = False
+        return length[2]
+
+    def _sample_length(self, bpm, rate):
+        """sample_length()の実際の処理．サブクラスで実装する"""
+        raise NotImplementedError
+
+    def render_into(self, out, bpm, rate, key_conf=None, start=0,
+                    oscillator=None):
+        """波形を生成してoutの先頭から足し込む
+
+        generate_wave()と同じ波形のうち，start番目のサンプルから
+        len(out)個分を，新しい配列を作らずにoutへ加算する．
+        計算はoutの型で行う．同じ構造の波形がsubtree_cacheにあればそれを
+        足す．measure_length()で曲の中に同じ構造が2度以上あると分かった
+        要素は，1度だけ_shared_wave()で描いてキャッシュに登録する
+        out : ndarray(またはそのスライス)．波形の終わりより後ろは変更しない
+        start : 書き込みを始める波形上の位置
+        """
+        if self.silent:
+            return
+
+        wave = subtree_cache.lookup(
+            (self.structure_id(), (bpm, rate, key_conf, oscillator,
+                                   out.dtype)))
+        if wave is None and self._use_shared_wave(bpm, rate, out.dtype):
+            wave = self._shared_wave(bpm, rate, key_conf, oscillator,
+                                     out.dtype)
+        if wave is not None:
+            wave = wave[start:start + len(out)]
+            out[:len(wave)] += wave
+            return
+        self._render_into(out, bpm, rate, key_conf, start, oscillator)
+
+    def _shared_wave(self, bpm, rate, key_conf=None, oscillator=None,
+                     dtype=np.float64):
+        """generate_wave()と同じ波形をsubtree_cacheを通して返す
+
+        キャッシュにない時はgenerate_wave()を再帰的に呼ばず，要素の長さの
+        配列を1つだけ確保してLeafRendererで描く
+        """
+        def render():
+            wave = np.zeros(self.sample_length(bpm, rate), dtype=dtype)
+            LeafRenderer(self, bpm, rate, oscillator, key_conf,
+                         dtype).render_into(wave, 0)
+            return wave
+
+        return subtree_cache.get(
+            (self.structure_id(), (bpm, rate, key_conf, oscillator,
+                                   np.dtype(dtype))), render)
+
+    def _use_shared_wave(self, bpm, rate, dtype):
+        """波形を1度だけ描いてsubtree_cacheで共有する要素ならTrue
+
+        同じ構造が曲の中に2度以上あり，長さを求めてあって，その波形が
+        subtree_cacheの上限に収まる時
+        """
+        length = self._length
+        return (self._shared and length is not None and
+                length[:2] == (bpm, rate) and
+                length[2] * np.dtype(dtype).itemsize <=
+                subtree_cache.max_bytes)
+
+    def _render_into(self, out, bpm, rate, key_conf=None, start=0,
+                     oscillator=None):
+        """render_into()の実際の処理．サブクラスで実装する"""
+        raise NotImplementedError
+
+    def compile_events(self, compiler, beat, key_conf=None):
+        """音符をイベントとしてcompilerに登録し，拍数で表した長さを返す
+
+        compiler : ScoreCompilerインスタンス
+        beat : このMusicComponentの開始位置(4分音符が1)
         """
         raise NotImplementedError
 
@@ -132,93 +450,203 @@ class Rest(MusicComponent):
     def __init__(self, length=1):
         """lenght: 休符の長さ"""
 
+        super().__init__()
+
         self.length = length
 
-    def generate_wave(self, bpm, rate, key_conf=None):
-        zero_wave = np.zeros(int(self.length * (60 / bpm) * rate))
-        return zero_wave
+    def _is_silent(self):
+        return True  # 波形はgenerate_wave()で必要な時だけ0で作る
+
+    def _sample_length(self, bpm, rate):
+        return int(self.length * (60 / bpm) * rate)
+
+    def compile_events(self, compiler, beat, key_conf=None):
+        return self.length
+
+    def structure_key(self):
+        return (self.length,)
 
 
 class Note(MusicComponent):
     """単一の音符を表すクラス"""
 
-    def __init__(self, scale, length=1):
+    def __init__(self, scale, length=1, envelope=None):
         """イニシャライザ
 
-        scale : 音名 ("D3", "c#5" など)
+        scale : 音名 ("D3", "c#5" など)．不正な音名の場合は
+                pitch.InvalidScaleError(ValueError)を送出する
         lenght : 休符の長さ
+        envelope : 音の形を決めるEnvelopeインスタンス．
+                   Noneなら対数正規分布の形(DEFAULT_ENVELOPE)
         """
 
         super().__init__()
 
         self.scale = scale
         self.length = length
+        self.envelope = envelope or DEFAULT_ENVELOPE
 
-    def generate_wave(self, bpm, rate, key_conf=None):
-        freq = self._freq_from_scale(self.scale, key_conf)
-
-        step = (2 * math.pi) * freq / rate  # 2πf*(1/rate)
-        wave = np.sin(
-            step *
-            np.arange(int(self.length * (60 / bpm) * rate)))  # sin(2πft)
-        # wave *= np.linspace(1.5, 0.3, len(wave))
-        # rv = scipy.stats.beta(1.5, 3) # ベータ分布の形を使って音を滑らかにする
-        rv = scipy.stats.lognorm(1.5)  # 対数正規分布の形を使って音を滑らかにする
-        wave *= rv.pdf(np.linspace(0, 1, len(wave)))
-        return wave
+    @property
+    def scale(self):
+        return self._scale
 
-    def _freq_from_scale(self, scale, key_conf):
-        """単一のscaleに対する周波数を返す
+    @scale.setter
+    def scale(self, scale):
+        """音名は設定した時に1度だけ解析して音高コード(pitch)にしておく"""
+        self.pitch = parse_scale(scale)
+        self._scale = scale
+
+    def frequency(self, key_conf=None):
+        """調key_confでの周波数を返す
 
         例： "c#5" -> 554.365, "a5"-> 880.000
         """
         key_conf = key_conf or KeyConfig()
+        return key_conf.frequency_table()[self.pitch]
 
-        # 正規表現で音階，変化記号，オクターブ番号を抽出
-        match = re.match(r'([a-gA-G])([b#]?)([0-9]+)$', scale)
-        if match is None:
-            raise Exception
-        key, accidental, octave_str = match.groups()
+    def _generate_wave(self, bpm, rate, key_conf=None, oscillator=None,
+                       dtype=np.float64):
+        freq = self.frequency(key_conf)
 
-        factor = key_conf.factor_for_key(key.upper())
-        octave = int(octave_str)
+        n = self.sample_length(bpm, rate)
+        # 同じ高さ・長さの波形はキャッシュから読み出す
+        wave = wave_cache.wave(freq, n, rate, oscillator, dtype)
+        wave = wave * self.envelope.get(n, dtype)
+        return wave
 
-        if accidental == '#':
-            factor += 1
-        elif accidental == 'b':
-            factor -= 1
-        elif accidental == 'n':
-            factor = KeyConfig().factor_for_key(key.upper())
+    def _sample_length(self, bpm, rate):
+        return int(self.length * (60 / bpm) * rate)
 
-        freq = 440 * (2**((octave - 4) + factor / 12))
-        return freq
+    def _render_into(self, out, bpm, rate, key_conf=None, start=0,
+                     oscillator=None):
+        n = self.sample_length(bpm, rate)
+        end = min(n, start + len(out))
+        if start >= end:
+            return
+
+        freq = self.frequency(key_conf)
+        wave = wave_cache.wave(freq, n, rate, oscillator, out.dtype)
+        envelope = self.envelope.get(n, out.dtype)
+        out[:end - start] += wave[start:end] * envelope[start:end]
+
+    def compile_events(self, compiler, beat, key_conf=None):
+        freq = self.frequency(key_conf)
+        compiler.add_note(beat, self.length, freq, self.envelope)
+        return self.length
+
+    def _is_silent(self):
+        return False
+
+    def structure_key(self):
+        return (self.pitch, self.length, self.envelope)
 
 
 class Chord(MusicComponent):
     """MusicComponentクラスのインスタンスを五線譜上で縦に結合するクラス
 
     同じ長さのNoteを結合すると和音になる
+    parallel : Trueなら要素をプロセスプールで並列に描く．Falseなら常に順番に
+               描く．Noneなら要素数と長さが大きい時だけ並列に描く
     """
 
-    def __init__(self, components=None, key_conf=None):
+    def __init__(self, components=None, key_conf=None, parallel=None):
         super().__init__()
 
         self.components = components or []
         self.key_conf = key_conf
+        self.parallel = parallel
 
     def add(self, component):
         self.components.append(component)
+        component._add_parent(self)
+        self.invalidate()
 
-    def generate_wave(self, bpm, rate, base_key_conf=None):
+    def _generate_wave(self, bpm, rate, base_key_conf=None,
+                       oscillator=None, dtype=np.float64):
         key_conf = KeyConfig.merge(self.key_conf, base_key_conf)
-        waves = [c.generate_wave(bpm, rate, key_conf) for c in self.components]
-        wave = merge_waves(waves)
+        if self._is_uniform():
+            return self._uniform_wave(bpm, rate, key_conf, oscillator, dtype)
+
+        n = self.sample_length(bpm, rate)
+        if should_parallelize(len(self.components), n, self.parallel):
+            wave = np.zeros(n, dtype=dtype)
+            render_parallel(self.components, wave, bpm, rate, key_conf,
+                            oscillator=oscillator)
+            return wave
+
+        sounding = [c for c in self.components if not c.silent]  # 休符は足さない
+        if len(sounding) == 1 and sounding[0].sample_length(bpm, rate) == n:
+            # 音のある要素が1つだけなら，その波形をそのまま使う
+            return sounding[0].generate_wave(bpm, rate, key_conf, oscillator,
+                                             dtype)
+
+        wave = np.zeros(n, dtype=dtype)
+        for c in sounding:
+            child = c.generate_wave(bpm, rate, key_conf, oscillator, dtype)
+            wave[:len(child)] += child
         return wave
 
+    def _is_uniform(self):
+        """全ての要素が同じ長さ・エンベロープのNoteかどうか"""
+        first = self.components[0] if self.components else None
+        return isinstance(first, Note) and all(
+            isinstance(c, Note) and c.length == first.length and
+            c.envelope == first.envelope for c in self.components)
+
+    def _uniform_wave(self, bpm, rate, key_conf, oscillator=None,
+                      dtype=np.float64, start=0, end=None):
+        """同じ長さ・エンベロープのNoteからなる和音の波形をまとめて生成する
+
+        全音符の波形を一度に計算して足し，エンベロープは和に1度だけ掛ける
+        """
+        first = self.components[0]
+        n = first.sample_length(bpm, rate)
+        freqs = [c.frequency(key_conf) for c in self.components]
+        wave = wave_cache.chord(freqs, n, rate, oscillator, dtype)
+        return wave[start:end] * first.envelope.get(n, dtype)[start:end]
+
+    def _sample_length(self, bpm, rate):
+        return max(c.sample_length(bpm, rate) for c in self.components)
+
+    def _render_into(self, out, bpm, rate, base_key_conf=None, start=0,
+                     oscillator=None):
+        key_conf = KeyConfig.merge(self.key_conf, base_key_conf)
+        if self._is_uniform():
+            end = min(self.sample_length(bpm, rate), start + len(out))
+            if start < end:
+                out[:end - start] += self._uniform_wave(
+                    bpm, rate, key_conf, oscillator, out.dtype, start, end)
+            return
+
+        # outは曲の終わりまで続くことがあるので，和音の範囲だけに切り詰めて
+        # 並列化するかを決め，共有メモリもその大きさだけ確保する
+        out = out[:max(self.sample_length(bpm, rate) - start, 0)]
+        if should_parallelize(len(self.components), len(out), self.parallel):
+            render_parallel(self.components, out, bpm, rate, key_conf, start,
+                            oscillator)
+            return
+
+        for c in self.components:  # 全ての要素を同じ位置から重ねる
+            c.render_into(out, bpm, rate, key_conf, start, oscillator)
+
+    def compile_events(self, compiler, beat, base_key_conf=None):
+        key_conf = KeyConfig.merge(self.key_conf, base_key_conf)
+        return max(c.compile_events(compiler, beat, key_conf)
+                   for c in self.components)
+
+    def _is_silent(self):
+        return all(c.silent for c in self.components)
+
+    def structure_key(self):
+        return (self.key_conf,
+                tuple(c.structure_id() for c in self.components))
+
 
 class Series(MusicComponent):
     """MusicComponentクラスのインスタンスを五線譜上で時間方向に結合するクラス"""
 
+    _offsets = None  # ((bpm, rate), 各要素の開始位置のリスト)
+
     def __init__(self, components=None, key_conf=None):
         super().__init__()
 
@@ -227,21 +655,381 @@ class Series(MusicComponent):
 
     def add(self, component):
         self.components.append(component)
+        component._add_parent(self)
+        self.invalidate()
 
-    def add_tone(self, scales, length=1):
+    def add_tone(self, scales, length=1, envelope=None):
         scale_list = normalize_scale_argument(scales)
-        chord = Chord([Note(scale, length) for scale in scale_list])
-        self.components.append(chord)
+        self.add(Chord([Note(scale, length, envelope)
+                        for scale in scale_list]))
 
     def add_rest(self, length=1):
-        self.components.append(Rest(length))
+        self.add(Rest(length))
 
-    def generate_wave(self, bpm, rate, base_key_conf=None):
+    def _generate_wave(self, bpm, rate, base_key_conf=None,
+                       oscillator=None, dtype=np.float64):
         key_conf = KeyConfig.merge(self.key_conf, base_key_conf)
-        waves = [c.generate_wave(bpm, rate, key_conf) for c in self.components]
-        wave = np.concatenate(waves)
+        offsets = self._child_offsets(bpm, rate)
+        wave = np.zeros(offsets[-1], dtype=dtype)
+        for c, offset, next_offset in zip(self.components, offsets,
+                                          offsets[1:]):
+            if not c.silent:  # 休符は位置を進めるだけ
+                wave[offset:next_offset] = c.generate_wave(
+                    bpm, rate, key_conf, oscillator, dtype)
         return wave
 
+    def _child_offsets(self, bpm, rate):
+        """各要素の開始位置のリストを返す．最後の値は全体の長さ
+
+        bpmとrateごとに1度だけ求めて覚えておく
+        """
+        offsets = self._offsets
+        if offsets is None or offsets[0] != (bpm, rate):
+            offsets = self._offsets = ((bpm, rate), list(itertools.accumulate(
+                (c.sample_length(bpm, rate) for c in self.components),
+                initial=0)))
+            self._dirty = False
+        return offsets[1]
+
+    def _sample_length(self, bpm, rate):
+        return self._child_offsets(bpm, rate)[-1]
+
+    def _render_into(self, out, bpm, rate, base_key_conf=None, start=0,
+                     oscillator=None):
+        key_conf = KeyConfig.merge(self.key_conf, base_key_conf)
+        offsets = self._child_offsets(bpm, rate)
+        end = start + len(out)
+        # startを含む要素から始め，前の要素の直後に続けて書き込む
+        first = max(bisect.bisect_right(offsets, start) - 1, 0)
+        for i in range(first, len(self.components)):
+            offset = offsets[i]  # 要素の波形上の開始位置
+            if offset >= end:
+                break
+            c = self.components[i]
+            if offset >= start:
+                c.render_into(out[offset - start:], bpm, rate, key_conf,
+                              oscillator=oscillator)
+            else:
+                c.render_into(out, bpm, rate, key_conf, start - offset,
+                              oscillator)
+
+    def compile_events(self, compiler, beat, base_key_conf=None):
+        key_conf = KeyConfig.merge(self.key_conf, base_key_conf)
+        length = 0
+        for c in self.components:
+            length += c.compile_events(compiler, beat + length, key_conf)
+        return length
+
+    def _is_silent(self):
+        return all(c.silent for c in self.components)
+
+    def structure_key(self):
+        return (self.key_conf,
+                tuple(c.structure_id() for c in self.components))
+
+
+class Repeat(MusicComponent):
+    """MusicComponentをtimes回繰り返すクラス
+
+    繰り返す要素の波形は1度だけ生成し，それを並べて出力する
+    """
+
+    def __init__(self, component, times=2):
+        super().__init__()
+
+        self.component = component
+        self.times = times
+
+    def _generate_wave(self, bpm, rate, key_conf=None, oscillator=None,
+                       dtype=np.float64):
+        wave = self.component.generate_wave(bpm, rate, key_conf, oscillator,
+                                            dtype)
+        return np.tile(wave, self.times)
+
+    def _sample_length(self, bpm, rate):
+        return self.component.sample_length(bpm, rate) * self.times
+
+    def _render_into(self, out, bpm, rate, key_conf=None, start=0,
+                     oscillator=None):
+        n = self.component.sample_length(bpm, rate)
+        end = min(n * self.times, start + len(out))
+        if start >= end:
+            return
+
+        wave = self.component._shared_wave(bpm, rate, key_conf, oscillator,
+                                           out.dtype)
+        position = start  # 曲の上で書き込む位置
+        while position < end:  # 繰り返しの境目ごとに区切って足す
+            offset = position % n
+            length = min(n - offset, end - position)
+            out[position - start:position - start + length] += \
+                wave[offset:offset + length]
+            position += length
+
+    def compile_events(self, compiler, beat, key_conf=None):
+        length = 0
+        for _ in range(self.times):
+            length += self.component.compile_events(compiler, beat + length,
+                                                    key_conf)
+        return length
+
+    def _is_silent(self):
+        return self.component.silent
+
+    def structure_key(self):
+        return (self.times, self.component.structure_id())
+
+
+class _Frame(object):
+    """iter_fragments()のスタックに積む，たどっている途中の要素"""
+
+    __slots__ = ('component', 'offset', 'key_conf', 'index', 'length')
+
+    def __init__(self, component, offset, key_conf):
+        self.component = component
+        self.offset = offset  # 要素の開始位置
+        self.key_conf = key_conf  # 親から渡された調
+        self.index = 0  # 次にたどる子(Repeatでは繰り返し)の番号
+        self.length = 0  # たどり終えた子から分かった要素の長さ
+
+
+def iter_fragments(component, bpm, rate, key_conf=None, oscillator=None,
+                   dtype=np.float64, render=True, counts=None):
+    """componentの木を再帰せずにたどり，(開始位置, 波形)を順に返す
+
+    木は明示的なスタックでたどるので，何千段も入れ子になった木でも
+    RecursionErrorにならない．波形は音符(または同じ長さの音符の和音)
+    ごとに1つずつ返し，波形はsubtree_cacheの上限までしか覚えないので，
+    呼び出し側が受け取った断片を足し込んでいけば，メモリは木の大きさでは
+    なく鳴っている音符の数で決まる．休符は位置を進めるだけで何も返さない
+    render : Falseなら波形を作らずに長さだけを求める．長さなどを覚えて
+             いる要素の子はたどらない
+    counts : render=Falseの時，構造の番号 -> 最初に現れた要素の辞書．
+             2度目に現れた構造には_count_structure()で共有する印を付ける
+    戻り値(StopIteration.value) : 木全体のサンプル数
+
+    render=Falseの時は各要素の長さ，構造の番号と無音かどうかも子から順に
+    求めて要素に覚えさせるので，その後のsample_length()などは木を
+    再帰的にたどらない
+    """
+    stack = [_Frame(component, 0, key_conf)]
+    returned = 0  # 最後にたどり終えた要素の長さ
+    while stack:
+        frame = stack[-1]
+        c = frame.component
+        if not render and frame.index == 0 and c._length is not None and \
+                c._length[:2] == (bpm, rate) and \
+                c._structure_id is not None and c._silent is not None:
+            stack.pop()
+            returned = c._length[2]
+            _count_structure(c, counts)
+            continue
+
+        child = None
+        child_key_conf = frame.key_conf
+        if isinstance(c, Series):
+            if frame.index > 0:  # 前の子の直後に続ける
+                frame.length += returned
+            if frame.index < len(c.components):
+                child = c.components[frame.index]
+                offset = frame.offset + frame.length
+                child_key_conf = KeyConfig.merge(c.key_conf, frame.key_conf)
+        elif isinstance(c, Chord) and not c._is_uniform():
+            if frame.index > 0:  # 全ての子を同じ位置から重ねる
+                frame.length = max(frame.length, returned)
+            if frame.index < len(c.components):
+                child = c.components[frame.index]
+                offset = frame.offset
+                child_key_conf = KeyConfig.merge(c.key_conf, frame.key_conf)
+        elif isinstance(c, Repeat):
+            if frame.index > 0:
+                frame.length = returned  # 繰り返す要素の長さ
+            if frame.index < c.times:
+                child = c.component
+                offset = frame.offset + frame.index * frame.length
+            else:
+                frame.length *= c.times
+        else:  # Rest, Note, 同じ長さの音符の和音などはまとめて扱う
+            frame.length = c.sample_length(bpm, rate)
+            if render and not isinstance(c, Rest) and frame.length:
+                yield frame.offset, c.generate_wave(bpm, rate, frame.key_conf,
+                                                    oscillator, dtype)
+
+        if child is None:  # この要素はたどり終えた
+            stack.pop()
+            returned = frame.length
+            c._length = (bpm, rate, frame.length)
+            c._dirty = False
+            if not render:  # 子の値は覚えてあるので再帰しない
+                c.structure_id()
+                _count_structure(c, counts)
+            continue
+
+        frame.index += 1
+        stack.append(_Frame(child, offset, child_key_conf))
+    return returned
+
+
+def _count_structure(component, counts):
+    """componentの構造が2度目に現れたら，最初の要素とともに共有する印を付ける
+
+    同じ要素が木の2か所にある場合も2度目として数える
+    """
+    if counts is None or component.silent:
+        return
+    structure_id = component.structure_id()
+    first = counts.get(structure_id)
+    if first is None:
+        counts[structure_id] = component
+    else:
+        first._shared = component._shared = True
+
+
+def measure_length(component, bpm, rate, counts=None):
+    """componentの木を再帰せずにたどってサンプル数を求める
+
+    各要素の長さなども覚えさせるので，深い木でもその後のsample_length()や
+    iter_leaves()がRecursionErrorにならない．曲の中に2度以上現れる構造の
+    要素には，render_into()がその波形を1度だけ描いて共有する印を付ける
+    counts : 何度かに分けてたどる時に共有する，構造の番号の辞書
+    """
+    if counts is None:
+        counts = {}
+    lengths = iter_fragments(component, bpm, rate, render=False,
+                             counts=counts)
+    try:
+        next(lengths)  # render=Falseでは断片を返さずに終わる
+    except StopIteration as stop:
+        return stop.value
+
+
+def iter_leaves(component, bpm, rate, key_conf=None, dtype=np.float64):
+    """componentの木を再帰せずにたどり，(開始位置, 要素, 調)を開始位置の順に返す
+
+    要素はNoteや同じ長さの音符の和音など，それ以上たどらない要素と，
+    曲の中に何度も現れるので波形をsubtree_cacheで共有する要素で，
+    休符は返さない．たどっている途中の要素は開始位置の順にヒープへ並べ，
+    SeriesとRepeatは次の子だけを積むので，ヒープの大きさは木の深さと
+    同時に始まる要素の数くらいで済む．子の長さは積む時にその子だけを
+    measure_length()で求めるので，最初の要素は曲の長さによらずすぐに返る
+    dtype : 波形を描く型．共有する波形がsubtree_cacheに収まるかを決める
+    """
+    counts = {}  # measure_length()で数えた構造
+    order = itertools.count()  # 開始位置が同じものはたどった順に返す
+    # (開始位置, 順番, 要素, 調, 次にたどる子の番号．Noneならまだ開いていない)
+    heap = [(0, next(order), component, key_conf, None)]
+    while heap:
+        offset, _, c, key_conf, index = heapq.heappop(heap)
+        if index is None:  # 初めて取り出した要素
+            if c is not component and not c.silent and \
+                    c._use_shared_wave(bpm, rate, dtype):
+                yield offset, c, key_conf  # 子はたどらずにまとめて描く
+                continue
+            if isinstance(c, Chord) and not c._is_uniform():
+                key_conf = KeyConfig.merge(c.key_conf, key_conf)
+                for child in c.components:  # 全ての子を同じ位置から重ねる
+                    heapq.heappush(
+                        heap, (offset, next(order), child, key_conf, None))
+                continue
+            if isinstance(c, Series):
+                key_conf = KeyConfig.merge(c.key_conf, key_conf)
+            elif not isinstance(c, Repeat):
+                if not isinstance(c, Rest) and c.sample_length(bpm, rate):
+                    yield offset, c, key_conf
+                continue
+            index = 0
+
+        # 次の子と，その直後に続きをたどる位置を積む
+        if isinstance(c, Series):
+            if index < len(c.components):
+                child = c.components[index]
+            else:
+                continue
+        elif index < c.times:
+            child = c.component
+        else:
+            continue
+        length = measure_length(child, bpm, rate, counts)
+        heapq.heappush(heap, (offset, next(order), child, key_conf, None))
+        heapq.heappush(heap, (offset + length, next(order), c, key_conf,
+                              index + 1))
+
+
+class LeafRenderer(object):
+    """iter_leaves()の要素を，曲の先頭から順に要求された範囲へ描くクラス
+
+    範囲に重なり始めた要素だけを鳴っている要素として持ち，範囲を過ぎた
+    要素は捨てるので，木の深さや大きさによらずブロックごとに描ける
+    key_conf : componentに親から渡す調
+    dtype : 描く配列の型
+    """
+
+    def __init__(self, component, bpm, rate, oscillator=None, key_conf=None,
+                 dtype=np.float64):
+        self.component = component
+        self.bpm = bpm
+        self.rate = rate
+        self.oscillator = oscillator
+        self._leaves = iter_leaves(component, bpm, rate, key_conf, dtype)
+        self._next = next(self._leaves, None)  # まだ鳴り始めていない要素
+        self._active = []  # (開始位置, 終了位置, 要素, 調)
+
+    @property
+    def exhausted(self):
+        """全ての要素が鳴り始めていればTrue"""
+        return self._next is None
+
+    def render_into(self, out, start):
+        """曲のstart番目のサンプルからlen(out)個分をoutへ足し込む
+
+        startは前に描いた範囲の終わり以上であること
+        """
+        end = start + len(out)
+        while self._next is not None and self._next[0] < end:
+            offset, c, key_conf = self._next
+            self._active.append((offset,
+                                 offset + c.sample_length(self.bpm, self.rate),
+                                 c, key_conf))
+            self._next = next(self._leaves, None)
+
+        active = []
+        for leaf in self._active:
+            offset, leaf_end, c, key_conf = leaf
+            if leaf_end <= start:
+                continue
+            # component自身はその波形を共有するために描いていることがある
+            # ので，キャッシュを引かずに描く
+            render = (c._render_into if c is self.component
+                      else c.render_into)
+            if offset >= start:
+                render(out[offset - start:], self.bpm, self.rate, key_conf,
+                       oscillator=self.oscillator)
+            else:
+                render(out, self.bpm, self.rate, key_conf, start - offset,
+                       self.oscillator)
+            if leaf_end > end:  # 次の範囲でも鳴っている
+                active.append(leaf)
+        self._active = active
+
+
+class ScoreCompiler(object):
+    """MusicComponentの木をたどって音符のイベントを集めるクラス"""
+
+    def __init__(self):
+        self.events = []
+        self.envelope_ids = {}
+
+    def add_note(self, beat, length, freq, envelope, amp=1.0):
+        envelope_id = self.envelope_ids.setdefault(envelope,
+                                                   len(self.envelope_ids))
+        self.events.append((beat, length, freq, amp, envelope_id))
+
+    def compile(self, component, bpm, rate):
+        """componentをCompiledScoreに変換する"""
+        beat_total = component.compile_events(self, 0)
+        return CompiledScore.from_events(self.events, self.envelope_ids,
+                                         beat_total, bpm, rate)
+
 
 class Music(object):
     """MusicComponentの波形を生成 & 鳴らすためのクラス
@@ -249,23 +1037,210 @@ class Music(object):
     component : MusicComponentインスタンス
     bpm : 一分間に４分音符が何回あるか
     rate : 波形のサンプルレート
+    oscillator : 音符の波形を作るOscillatorインスタンス，またはその名前
+                 ('sine', 'wavetable', 'square', 'saw', 'triangle')
+    dtype : 波形を生成する型．np.float32にすると最後まで単精度で計算するので
+            メモリ使用量が半分になる
+
+    generate_wave()，iter_blocks()，play()にquality='preview'を渡すと，
+    曲をresample.PREVIEW_RATEで生成してからrateへ変換する．確認用に
+    速く鳴らすためのもので，高い音は正しく鳴らない
     """
 
-    def __init__(self, component, bpm=90, rate=44100):
+    def __init__(self, component, bpm=90, rate=44100, oscillator=None,
+                 dtype=np.float64):
         self.bpm = bpm
         self.rate = rate
         self.component = component
+        self.oscillator = get_oscillator(oscillator)
+        self.dtype = dtype
+        self._compiled = None  # (componentの構造の番号, CompiledScore)
+
+    def compile(self):
+        """componentの木をイベント表(CompiledScore)にコンパイルする
+
+        調と時間の計算は木をたどるこの時に1度だけ行う．
+        componentを編集した後は，mode='compiled'で次に生成する時に
+        コンパイルし直す
+        """
+        compiled = ScoreCompiler().compile(self.component, self.bpm,
+                                           self.rate)
+        self._compiled = (self.component.structure_id(), compiled)
+        return compiled
+
+    def _compiled_score(self):
+        """コンパイル済みのイベント表を返す
+
+        コンパイルした後にcomponentの構造が変わっていればコンパイルし直す
+        """
+        if self._compiled is None or \
+                self._compiled[0] != self.component.structure_id():
+            return self.compile()
+        return self._compiled[1]
+
+    def _with_quality(self, quality):
+        """品質qualityで生成する時に使うMusicを返す
+
+        生成するサンプルレートがrateと同じならself，違えばcomponentを
+        共有してそのレートで生成するMusic
+        """
+        rate = render_rate(self.rate, quality)
+        if rate == self.rate:
+            return self
+        music = Music(self.component, self.bpm, rate, self.oscillator,
+                      self.dtype)
+        music._compiled = self._compiled  # rescale()で時間だけ計算し直す
+        return music
+
+    def generate_wave(self, mode='inplace', quality='full'):
+        """曲全体の波形を生成する
+
+        mode='inplace' : 先に曲全体のサンプル数を求めて出力バッファを
+                         1つだけ確保し，各MusicComponentがそのスライスへ
+                         直接書き込む．曲の中に何度も現れる部分木は
+                         1度だけ描いて共有する
+        mode='recursive' : 各MusicComponentのgenerate_wave()を再帰的に呼ぶ．
+                           生成した波形はsubtree_cacheの上限まで覚えておく
+                           ので，曲の一部を変更した後は変更した要素とその
+                           親だけを生成し直す
+        mode='compiled' : compile()したイベント表からまとめて生成する．
+                          bpmやrateを変えた場合は表の時間の列だけを，
+                          componentを編集した場合は表全体を計算し直す
+        mode='iterative' : iter_fragments()で木を再帰せずにたどり，
+                           音符ごとの断片を出力に足し込む．深い木や
+                           要素の多い木でも使える
+        quality : 'full'または'preview'．'preview'ではどのmodeでも低い
+                  サンプルレートで生成してからrateへ変換する
+        """
+        music = self._with_quality(quality)
+        if music is not self:
+            return resample(music.generate_wave(mode), music.rate, self.rate)
+
+        if mode == 'recursive':  # 覚えている波形は書き込み禁止なのでコピーする
+            return self.component.generate_wave(self.bpm, self.rate,
+                                                oscillator=self.oscillator,
+                                                dtype=self.dtype).copy()
+        if mode == 'compiled':
+            compiled = self._compiled_score()
+            return compiled.rescale(self.bpm, self.rate).render(
+                oscillator=self.oscillator, dtype=self.dtype)
+        if mode == 'iterative':
+            return self._generate_iterative()
+        if mode != 'inplace':
+            raise ValueError('unknown mode: {!r}'.format(mode))
+
+        out = np.zeros(measure_length(self.component, self.bpm, self.rate),
+                       dtype=self.dtype)
+        self.component.render_into(out, self.bpm, self.rate,
+                                   oscillator=self.oscillator)
+        return out
+
+    def _generate_iterative(self):
+        """iter_fragments()の断片を出力に足し込む
+
+        出力の大きさは先に波形を作らずにたどって求め，1度だけ確保する
+        """
+        out = np.zeros(measure_length(self.component, self.bpm, self.rate),
+                       dtype=self.dtype)
+        for offset, wave in iter_fragments(self.component, self.bpm,
+                                           self.rate,
+                                           oscillator=self.oscillator,
+                                           dtype=self.dtype):
+            out[offset:offset + len(wave)] += wave
+        return out
+
+    def iter_blocks(self, block_size=BLOCK_SIZE, quality='full'):
+        """曲の波形を先頭からblock_sizeサンプルずつ生成するジェネレータ
+
+        各ブロックは要求されたときに初めて生成されるので，曲の長さによらず
+        最初のブロックはすぐに得られる．木はLeafRendererで再帰せずに
+        たどるので，深い木でも鳴らせる．quality='preview'の時は低い
+        サンプルレートで生成したブロックを変換しながら返すので，
+        ブロックの長さはblock_sizeから少しずれることがある
+        """
+        music = self._with_quality(quality)
+        if music is not self:
+            size = max(block_size * music.rate // self.rate, 1)
+            yield from resample_blocks(music.iter_blocks(size), music.rate,
+                                       self.rate)
+            return
+
+        renderer = LeafRenderer(self.component, self.bpm, self.rate,
+                                self.oscillator, dtype=self.dtype)
+        total = None  # 曲のサンプル数．全ての要素が鳴り始めてから求める
+        start = 0
+        while total is None or start < total:
+            size = block_size if total is None else min(block_size,
+                                                        total - start)
+            block = np.zeros(size, dtype=self.dtype)
+            renderer.render_into(block, start)
+            if total is None and renderer.exhausted:
+                # 残りは鳴っている要素の続きと最後の休符だけ
+                total = measure_length(self.component, self.bpm, self.rate)
+                block = block[:max(total - start, 0)]
+            if len(block):
+                yield block
+            start += size
+
+    def render_to_file(self, path, volume=0.1, window=MEMMAP_WINDOW):
+        """曲を32ビット浮動小数点のWAVファイルへ書き出す
+
+        ファイルをnp.memmapでwindowサンプルずつ割り当て，LeafRendererで
+        その中へ直接書き込むので，曲全体の波形はメモリに置かず，深い木でも
+        書き出せる．
+        dtypeがnp.float32でない時は窓1つ分の作業用の配列で計算してから
+        書き込む．書き出したサンプル数を返す
+        """
+        renderer = LeafRenderer(self.component, self.bpm, self.rate,
+                                self.oscillator, dtype=self.dtype)
+
+        def render_window(out, start):
+            if out.dtype == self.dtype:
+                block = out
+            else:
+                block = np.zeros(len(out), dtype=self.dtype)
+            renderer.render_into(block, start)
+            np.multiply(block, volume, out=out, casting='same_kind')
+
+        total = measure_length(self.component, self.bpm, self.rate)
+        return render_wav_memmap(path, self.rate, total, render_window,
+                                 window)
+
+    def play(self, volume=0.1, stream=True, block_size=BLOCK_SIZE,
+             wait=True, quality='full'):
+        """曲を鳴らす
+
+        開いたままの共有の出力ストリーム(stream.get_output())の再生待ちの
+        列に入れる．stream=Trueの時，曲をブロックごとに生成しながら
+        再生する．Falseの時は曲全体をmode='recursive'で生成してから鳴らす
+        ので，曲の一部を変更して鳴らし直す時は変更していない部分の波形が
+        そのまま使われる．どちらの場合も前に生成した波形があれば使う
+        wait : Falseなら鳴らし終えるのを待たずにFutureを返す
+        quality : 'full'または'preview'．'preview'なら低いサンプルレートで
+                  生成してrateへ変換しながら鳴らす
+        """
+        if stream:
+            blocks = (block * volume
+                      for block in self.iter_blocks(block_size, quality))
+        else:
+            out_wave = self.generate_wave('recursive', quality)
+            out_wave *= volume
+            blocks = [out_wave]
 
-    def play(self, volume=0.1):
-        out_wave = self.component.generate_wave(self.bpm, self.rate) * volume
+        future = get_output().submit(blocks, self.rate, block_size=block_size)
+        if wait:
+            future.result()
+        return future
 
-        pa = pyaudio.PyAudio()
-        stream = pa.open(format=pyaudio.paFloat32, channels=1, rate=self.rate,
-                         output=True)
-        stream.write(out_wave.astype(np.float32).tostring())
+    async def play_async(self, volume=0.1, stream=True,
+                         block_size=BLOCK_SIZE, quality='full'):
+        """曲を鳴らすコルーチン．イベントループを止めずに再生を待つ"""
+        await asyncio.wrap_future(
+            self.play(volume, stream, block_size, wait=False,
+                      quality=quality))
 
 
-def tone(scales, length=1):
+def tone(scales, length=1, envelope=None):
     """和音を表現するMusicComponentを簡単に作るためのラッパー関数
 
     scale: 音符を表す文字列，またはそのリスト．音階の大文字小文字は区別しない
@@ -273,9 +1248,10 @@ def tone(scales, length=1):
         高いド#の音を鳴らす場合 "C#5"
         ドとミbの音を鳴らす場合 ["c4","Eb4"]
     length: 音の長さ．4分音符が1
+    envelope: 音の形を決めるEnvelopeインスタンス．Noneならデフォルトの形
     """
     scale_list = normalize_scale_argument(scales)
-    chord = Chord([Note(scale, length) for scale in scale_list])
+    chord = Chord([Note(scale, length, envelope) for scale in scale_list])
     return chord
 
 
@@ -403,13 +1379,15 @@ def jupiter(bpm=80):
 
 
 def main():
+    # 続けて再生待ちの列に入れると，前の曲を鳴らしている間に次の曲の
+    # 生成が始まり，曲間を空けずに鳴らせる
     ag = amazing_grace()
-    ag.play()
+    ag.play(wait=False)
     # ag.bpm = 180
-    # ag.play()
+    # ag.play(wait=False)
 
     cn = canon()
-    cn.play()
+    cn.play(wait=False)
 
     jp = jupiter()
     jp.play()
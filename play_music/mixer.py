@@ -0,0 +1,117 @@
+"""複数のパートの波形を1つの出力に合成するミキサー"""
+
+import bisect
+
+import numpy as np
+
+
+LIMITERS = (None, 'soft', 'hard')
+
+
+def pan_gains(pan):
+    """定パワーのパンで左右のチャンネルに掛ける係数を返す
+
+    pan : -1(左)から1(右)．0で中央
+    """
+    angle = (pan + 1) * np.pi / 4
+    return np.cos(angle), np.sin(angle)
+
+
+def limit(wave, limiter='soft', ceiling=1.0):
+    """波形の振幅をceiling以下に抑える(waveを書き換える)
+
+    limiter='soft' : ceiling * tanh(x / ceiling)で滑らかに抑える
+    limiter='hard' : ceilingで切り取る
+    """
+    if limiter == 'soft':
+        wave /= ceiling
+        np.tanh(wave, out=wave)
+        wave *= ceiling
+    elif limiter == 'hard':
+        np.clip(wave, -ceiling, ceiling, out=wave)
+    elif limiter is not None:
+        raise ValueError('unknown limiter: {!r}'.format(limiter))
+    return wave
+
+
+class Mixer(object):
+    """パートの波形にゲインとパンを掛けて足し合わせるクラス
+
+    出力は最初にパートの長さから大きさを決めて1度だけ確保し，各パートは
+    その中へ直接足し込む．ゲインを掛ける作業用の配列も出力1つにつき
+    1つだけ使い回すので，パートの数によらず一時的な配列は増えない
+    channels : 1ならモノラル，2なら(サンプル数, 2)のステレオで出力する
+    master_gain : 合成した後に全体に掛けるゲイン
+    limiter : None, 'soft'または'hard'．最後に振幅をceiling以下に抑える
+    dtype : 出力の型
+    """
+
+    def __init__(self, channels=1, master_gain=1.0, limiter=None,
+                 ceiling=1.0, dtype=np.float64):
+        if channels not in (1, 2):
+            raise ValueError('channels must be 1 or 2')
+        if limiter not in LIMITERS:
+            raise ValueError('unknown limiter: {!r}'.format(limiter))
+        self.channels = channels
+        self.master_gain = master_gain
+        self.limiter = limiter
+        self.ceiling = ceiling
+        self.dtype = np.dtype(dtype)
+        self.tracks = []
+
+    def add(self, wave, gain=1.0, pan=0.0, segments=None):
+        """合成するパートの波形を追加する．waveはコピーしない
+
+        pan : -1(左)から1(右)．モノラルの時は使わない
+        segments : 音のある範囲(start, end)の昇順のリスト．それ以外の
+                   範囲は無音として足さずに飛ばす．Noneなら全体
+        """
+        if segments is None:
+            segments = [(0, len(wave))]
+        self.tracks.append((wave, gain, pan, segments))
+
+    def __len__(self):
+        return max((len(wave) for wave, _, _, _ in self.tracks), default=0)
+
+    def mix(self, out=None, start=0):
+        """パートを合成してoutに書き込み，outを返す
+
+        out : 書き込む配列．Noneなら曲全体の大きさで確保する．与えた場合は
+              0で初期化されていること(np.memmapの窓などに直接書き込める)
+        start : outの先頭に対応する波形上の位置
+        """
+        if out is None:
+            shape = (len(self) - start,)
+            if self.channels == 2:
+                shape += (2,)
+            out = np.zeros(shape, dtype=self.dtype)
+
+        scratch = np.empty(len(out), dtype=out.dtype)
+        end = start + len(out)
+        for wave, gain, pan, segments in self.tracks:
+            # 窓の先頭を含む(またはそれより後ろの最初の)範囲から調べる
+            first = max(bisect.bisect_right(segments, (start, end)) - 1, 0)
+            for segment_start, segment_end in segments[first:]:
+                if segment_start >= end:
+                    break
+                low = max(segment_start, start)
+                high = min(segment_end, end, len(wave))
+                if low < high:  # 音のある範囲のうち窓に重なる部分だけ足す
+                    self._add(out[low - start:high - start], wave[low:high],
+                              gain, pan, scratch[:high - low])
+
+        if self.master_gain != 1:
+            out *= self.master_gain
+        if self.limiter is not None:
+            limit(out, self.limiter, self.ceiling)
+        return out
+
+    def _add(self, out, wave, gain, pan, scratch):
+        """gainとpanを掛けたwaveをoutに足す"""
+        if self.channels == 1:
+            np.multiply(wave, gain, out=scratch)
+            out += scratch
+            return
+        for channel, pan_gain in enumerate(pan_gains(pan)):
+            np.multiply(wave, gain * pan_gain, out=scratch)
+            out[:, channel] += scratch
@@ -0,0 +1,233 @@
+"""音符の波形を作るオシレータ
+
+SineOscillatorは従来どおりnp.sinで波形を計算する．
+WavetableOscillatorは1周期分の波形表を線形補間で読み出し，
+位相を積算しながら波形を作る．矩形波・のこぎり波・三角波の表は
+ナイキスト周波数を超える倍音を含まないよう倍音数ごとに用意する
+"""
+
+import math
+import time
+
+import numpy as np
+
+from synth import sine, sines, sum_of_sines
+
+
+class Oscillator(object):
+    """オシレータの抽象クラス
+
+    位相は1周期を1とした値で表す
+    """
+
+    def params(self):
+        """波形の種類を決めるパラメータのタプルを返す．キャッシュのキーに使う"""
+        return ()
+
+    def key(self):
+        return (self.__class__, self.params())
+
+    def render(self, freq, n, rate, phase=0.0, dtype=np.float64):
+        """位相phaseから始まる長さnの波形と，その次のサンプルの位相を返す
+
+        返した位相を次の呼び出しに渡すと波形が途切れずにつながる
+        dtype : 波形の型(np.float64またはnp.float32)
+        """
+        raise NotImplementedError
+
+    def wave(self, freq, n, rate, dtype=np.float64):
+        """位相0から始まる長さnの波形を返す"""
+        wave, _ = self.render(freq, n, rate, dtype=dtype)
+        return wave
+
+    def waves(self, freqs, n, rate, dtype=np.float64):
+        """周波数freqsそれぞれの波形を行とする2次元配列を返す"""
+        out = np.empty((len(freqs), n), dtype=dtype)
+        for row, freq in zip(out, freqs):
+            row[:] = self.wave(freq, n, rate, dtype)
+        return out
+
+    def chord(self, freqs, n, rate, dtype=np.float64):
+        """周波数freqsの波形をすべて足した波形を返す"""
+        out = np.zeros(n, dtype=dtype)
+        for freq in freqs:
+            out += self.wave(freq, n, rate, dtype)
+        return out
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.params() == other.params()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return '{}{}'.format(self.__class__.__name__, self.params())
+
+
+class SineOscillator(Oscillator):
+    """np.sinで1サンプルずつsin波を計算するオシレータ"""
+
+    def render(self, freq, n, rate, phase=0.0, dtype=np.float64):
+        wave = sine(freq, n, rate, dtype, phase)
+        return wave, (phase + freq * n / rate) % 1.0
+
+    def waves(self, freqs, n, rate, dtype=np.float64):
+        return sines(freqs, 0, n, rate, dtype)
+
+    def chord(self, freqs, n, rate, dtype=np.float64):
+        return sum_of_sines(freqs, n, rate, dtype)
+
+
+def _harmonics(waveform, count):
+    """波形waveformを作る倍音の(次数, 振幅)のリストを返す"""
+    if waveform == 'sine':
+        return [(1, 1.0)]
+    if waveform == 'square':
+        return [(k, 4 / (math.pi * k)) for k in range(1, count + 1, 2)]
+    if waveform == 'saw':
+        return [(k, (-1) ** (k + 1) * 2 / (math.pi * k))
+                for k in range(1, count + 1)]
+    if waveform == 'triangle':
+        return [(k, (-1) ** ((k - 1) // 2) * 8 / (math.pi * k) ** 2)
+                for k in range(1, count + 1, 2)]
+    raise ValueError('unknown waveform: {!r}'.format(waveform))
+
+
+class WavetableOscillator(Oscillator):
+    """波形表を線形補間で読み出すオシレータ
+
+    waveform : 'sine', 'square', 'saw', 'triangle'のいずれか
+    table_size : 1周期分の波形表のサンプル数(2の冪)
+    """
+
+    WAVEFORMS = ('sine', 'square', 'saw', 'triangle')
+
+    def __init__(self, waveform='sine', table_size=2048):
+        if waveform not in self.__class__.WAVEFORMS:
+            raise ValueError('unknown waveform: {!r}'.format(waveform))
+        if table_size & (table_size - 1):
+            raise ValueError('table_size must be a power of 2')
+        self.waveform = waveform
+        self.table_size = table_size
+        self._tables = {}
+
+    def params(self):
+        return (self.waveform, self.table_size)
+
+    def table(self, freq, rate, dtype=np.float64):
+        """周波数freqで鳴らしても折り返し雑音が出ない波形表を返す
+
+        倍音数はナイキスト周波数以下に収まる最大の2の冪に丸めて，
+        同じ倍音数の表を使い回す．
+        波形表と，補間に使う隣のサンプルとの差の表の組を返す
+        """
+        limit = max(1, int(rate / 2 / freq))
+        count = 1 << (limit.bit_length() - 1)
+        key = (count, np.dtype(dtype))
+        tables = self._tables.get(key)
+        if tables is None:
+            x = (2 * math.pi / self.table_size) * np.arange(
+                self.table_size + 1)
+            table = np.zeros(self.table_size + 1)
+            for k, amplitude in _harmonics(self.waveform, count):
+                table += amplitude * np.sin(k * x)
+            tables = (table[:-1].astype(dtype), np.diff(table).astype(dtype))
+            self._tables[key] = tables
+        return tables
+
+    def render(self, freq, n, rate, phase=0.0, dtype=np.float64):
+        table, slope = self.table(freq, rate, dtype)
+        size = self.table_size
+        increment = freq * size / rate  # 1サンプルごとに進む表の位置
+
+        # 位相を積算して表の読み出し位置を求める．表の型によらず
+        # 読み出し位置は倍精度で計算する
+        position = np.arange(n, dtype=np.float64)
+        position *= increment
+        position += phase * size
+
+        index = position.astype(np.intp)
+        position -= index  # 補間の重み
+        index &= size - 1  # 表の長さが2の冪なので剰余の代わりにマスクする
+        wave = slope[index]
+        wave *= position
+        wave += table[index]
+        return wave, (phase + freq * n / rate) % 1.0
+
+    def waves(self, freqs, n, rate, dtype=np.float64):
+        return np.stack([self.wave(freq, n, rate, dtype) for freq in freqs])
+
+
+DEFAULT_OSCILLATOR = SineOscillator()
+
+
+def get_oscillator(oscillator=None):
+    """名前またはOscillatorインスタンスからOscillatorを返す
+
+    None, 'sine' : SineOscillator (np.sin)
+    'wavetable' : sin波のWavetableOscillator
+    'square', 'saw', 'triangle' : 各波形のWavetableOscillator
+    """
+    if oscillator is None:
+        return DEFAULT_OSCILLATOR
+    if isinstance(oscillator, Oscillator):
+        return oscillator
+    if oscillator == 'sine':
+        return SineOscillator()
+    if oscillator == 'wavetable':
+        return WavetableOscillator('sine')
+    return WavetableOscillator(oscillator)
+
+
+def benchmark(n=441000, repeat=5, freq=440.0, rate=44100, dtype=np.float64):
+    """各オシレータの1秒あたりの生成サンプル数を返す"""
+    oscillators = {
+        'np.sin': SineOscillator(),
+        'wavetable-sine': WavetableOscillator('sine'),
+        'wavetable-square': WavetableOscillator('square'),
+        'wavetable-saw': WavetableOscillator('saw'),
+        'wavetable-triangle': WavetableOscillator('triangle'),
+    }
+    result = {}
+    for name, oscillator in oscillators.items():
+        oscillator.wave(freq, 16, rate, dtype)  # 波形表を作っておく
+        best = float('inf')
+        for _ in range(repeat):
+            begin = time.perf_counter()
+            oscillator.wave(freq, n, rate, dtype)
+            best = min(best, time.perf_counter() - begin)
+        result[name] = n / best
+    return result
+
+
+def float32_accuracy(seconds=60, freqs=(27.5, 440.0, 4186.0), rate=44100):
+    """単精度で生成した長い音の倍精度との誤差を調べる
+
+    各オシレータ・周波数について，seconds秒の音を単精度と倍精度で生成した時の
+    最大誤差をdB(振幅1に対する比)で返す．振幅1のsin波では誤差は位相の誤差
+    (ラジアン)にほぼ等しい．-90dBを下回れば16ビットの量子化雑音より小さい
+    """
+    oscillators = {
+        'np.sin': SineOscillator(),
+        'wavetable-sine': WavetableOscillator('sine'),
+    }
+    n = int(seconds * rate)
+    result = {}
+    for name, oscillator in oscillators.items():
+        for freq in freqs:
+            exact = oscillator.wave(freq, n, rate, np.float64)
+            single = oscillator.wave(freq, n, rate, np.float32)
+            error = np.max(np.abs(exact - single))
+            result[(name, freq)] = 20 * math.log10(max(error, 1e-300))
+    return result
+
+
+if __name__ == '__main__':
+    for dtype in (np.float64, np.float32):
+        print(np.dtype(dtype).name)
+        for name, samples_per_sec in benchmark(dtype=dtype).items():
+            print('{:<20s}{:>14,.0f} samples/s'.format(name, samples_per_sec))
+        print()
+    print('float32 error of 60 s notes')
+    for (name, freq), error_db in float32_accuracy().items():
+        print('{:<20s}{:>8.1f} Hz{:>8.1f} dB'.format(name, freq, error_db))
@@ -0,0 +1,102 @@
+"""Chordの要素を複数のプロセスで並列に描くための関数
+
+ワーカーは共有メモリ(multiprocessing.shared_memory)上の出力のうち，
+互いに重ならない時間の区間に波形を直接書き込むので，大きな配列を
+pickleしてプロセス間で受け渡す必要がなく，共有メモリも出力1つ分で済む
+"""
+
+import concurrent.futures
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+PARALLEL_THRESHOLD = 1 << 22  # 並列化する最小の(サンプル数×要素数)
+MAX_WORKERS = os.cpu_count() or 1
+
+_executor = None
+_in_worker = False  # ワーカーの中ではさらに並列化しない
+
+
+def should_parallelize(n_components, n_samples, parallel=None):
+    """並列に描くかどうかを決める
+
+    parallel : Trueなら常に，Falseなら決して並列化しない．
+               Noneならn_samples×n_componentsがPARALLEL_THRESHOLD以上の時
+    """
+    if _in_worker or n_components < 2 or parallel is False:
+        return False
+    if parallel:
+        return True
+    return n_components * n_samples >= PARALLEL_THRESHOLD and MAX_WORKERS > 1
+
+
+def get_executor():
+    """プロセスプールを返す．最初に呼ばれた時に作る
+
+    ワーカーはforkではなくforkserver(使えない環境ではspawn)で起動する．
+    forkすると，再生やバッチのスレッドがその時に持っていたロック
+    (ArrayCacheのロックなど)がワーカーの中で取られたままになり，
+    最初にキャッシュを引いたところで止まってしまう．ワーカーは
+    呼び出したスクリプトを読み込み直すので，スクリプトの処理は
+    if __name__ == '__main__':の中に書くこと
+    """
+    global _executor
+    if _executor is None:
+        methods = multiprocessing.get_all_start_methods()
+        method = 'forkserver' if 'forkserver' in methods else 'spawn'
+        _executor = concurrent.futures.ProcessPoolExecutor(
+            MAX_WORKERS, mp_context=multiprocessing.get_context(method))
+    return _executor
+
+
+def render_parallel(components, out, bpm, rate, key_conf=None, start=0,
+                    oscillator=None):
+    """componentsを同じ位置から重ねた波形をプロセスプールで描いてoutに足す
+
+    outをワーカー数の時間の区間に分け，区間ごとに全ての要素を共有メモリの
+    その区間へ描かせてから，outへ足し込む．MusicComponent.render_into()と
+    同じ引数をとる
+    """
+    n_windows = min(MAX_WORKERS, len(out))
+    if n_windows == 0:
+        return
+    executor = get_executor()
+    bounds = [len(out) * i // n_windows for i in range(n_windows + 1)]
+
+    shm = shared_memory.SharedMemory(
+        create=True, size=len(out) * out.itemsize)
+    try:
+        shared = np.ndarray(out.shape, dtype=out.dtype, buffer=shm.buf)
+        shared.fill(0)
+        futures = [
+            executor.submit(_render_window, shm.name, out.shape, out.dtype,
+                            begin, end, components, bpm, rate, key_conf,
+                            start, oscillator)
+            for begin, end in zip(bounds, bounds[1:])]
+        for future in futures:
+            future.result()
+        out += shared
+        del shared  # 共有メモリを閉じる前にビューを手放す
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _render_window(shm_name, shape, dtype, begin, end, components, bpm, rate,
+                   key_conf, start, oscillator):
+    """(ワーカープロセス) componentsの波形のうち共有メモリの[begin, end)を描く"""
+    global _in_worker
+    _in_worker = True
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        out = np.ndarray(shape, dtype=dtype, buffer=shm.buf)[begin:end]
+        for component in components:
+            component.render_into(out, bpm, rate, key_conf, start + begin,
+                                  oscillator)
+        del out
+    finally:
+        shm.close()
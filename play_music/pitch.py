@@ -0,0 +1,73 @@
+"""音名の解析と周波数表
+
+音名("c#5"など)は音符を作る時に1度だけ解析して整数の音高コードにする．
+周波数は調ごとに用意した周波数表を音高コードで引くだけで求まる
+"""
+
+import functools
+import re
+
+
+LETTERS = 'CDEFGAB'
+ACCIDENTALS = ('', '#', 'b', 'n')  # 変化記号なし，シャープ，フラット，ナチュラル
+MAX_OCTAVE = 10
+
+BASE_KEY_FACTOR = {  # ラの音を基準にしたときの半音の隔たり
+    'C': -9,
+    'D': -7,
+    'E': -5,
+    'F': -4,
+    'G': -2,
+    'A': 0,
+    'B': 2,
+}
+
+_SCALE_PATTERN = re.compile(r'([a-gA-G])([b#n]?)([0-9]+)$')
+
+
+class InvalidScaleError(ValueError):
+    """音名として解釈できない文字列が渡された時に送出される例外"""
+
+
+def parse_scale(scale):
+    """音名を音高コードに変換する
+
+    例： "c4" -> 音高コード, "C#5"，"Bb3"，"En4"(ナチュラル)も可
+    音名が不正な場合はInvalidScaleErrorを送出する
+    """
+    match = (_SCALE_PATTERN.match(scale) if isinstance(scale, str)
+             else None)
+    if match is None or int(match.group(3)) > MAX_OCTAVE:
+        raise InvalidScaleError(
+            '音名として解釈できません: {!r} (例: "c4", "F#5", "Bb3")'.format(
+                scale))
+    key, accidental, octave_str = match.groups()
+
+    return ((int(octave_str) * len(LETTERS) + LETTERS.index(key.upper())) *
+            len(ACCIDENTALS) + ACCIDENTALS.index(accidental))
+
+
+def frequency_table(key_factor):
+    """調に対する周波数表(音高コード -> 周波数のリスト)を返す
+
+    key_factor : 音階ごとの，ラの音を基準にした半音の隔たりの辞書．
+                 調号で変化させた値を渡す
+    """
+    return _frequency_table(tuple(key_factor[key] for key in LETTERS))
+
+
+@functools.lru_cache(maxsize=None)
+def _frequency_table(factors):
+    table = []
+    for octave in range(MAX_OCTAVE + 1):
+        for key, key_factor in zip(LETTERS, factors):
+            for accidental in ACCIDENTALS:
+                factor = key_factor
+                if accidental == '#':
+                    factor += 1
+                elif accidental == 'b':
+                    factor -= 1
+                elif accidental == 'n':
+                    factor = BASE_KEY_FACTOR[key]
+                table.append(440 * (2**((octave - 4) + factor / 12)))
+    return table
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""曲を音声デバイスを使わずにWAVファイルへ書き出すコマンド
+
+例:
+    python render.py canon -o canon.wav
+    python render.py jupiter -o jupiter.wav --format float32 --bpm 100
+    python render.py main:canon -o canon.wav  # main.pyの曲
+    python render.py canon -o canon.wav --memmap  # ファイルへ直接書き込む
+    python render.py myscore:build -o out.wav  # 自作のモジュールの関数
+"""
+
+import argparse
+import importlib
+import inspect
+
+import main2
+from main import Music, MusicPart
+from stream import BLOCK_SIZE
+from wavfile import FORMATS, MEMMAP_WINDOW, WavWriter
+
+
+SCORES = ('amazing_grace', 'canon', 'jupiter')
+
+
+def load_score(name, bpm=None):
+    """名前から曲のインスタンスを作る
+
+    name : main2.pyの曲の関数名，または"モジュール名:関数名"．
+           関数はmain.py/main2.pyのMusicかMusicPartを返すこと
+    bpm : 指定した場合は関数にbpm引数として渡す．関数がbpm引数を
+          取らない場合はTypeErrorを送出する
+    """
+    module_name, _, function_name = name.rpartition(':')
+    module = importlib.import_module(module_name) if module_name else main2
+    function = getattr(module, function_name)
+    if bpm is None:
+        return function()
+    if not _takes_bpm(function):
+        raise TypeError('{} does not take a bpm argument'.format(name))
+    return function(bpm=bpm)
+
+
+def _takes_bpm(function):
+    """functionにbpmをキーワード引数として渡せるかどうか"""
+    try:
+        parameters = inspect.signature(function).parameters.values()
+    except (TypeError, ValueError):  # シグネチャが分からない場合は渡してみる
+        return True
+    return any(p.kind == p.VAR_KEYWORD or
+               (p.name == 'bpm' and p.kind != p.POSITIONAL_ONLY)
+               for p in parameters)
+
+
+def music_rate(music):
+    """曲のサンプルレートを返す"""
+    return getattr(music, 'rate', None) or MusicPart.RATE
+
+
+def iter_music_blocks(music, block_size=BLOCK_SIZE, volume=0.1):
+    """曲の出力波形をblock_sizeサンプルずつ返すジェネレータ
+
+    main2.pyのMusicにはplay()と同じくvolumeを掛ける．main.pyのMusicや
+    MusicPartはパートごとの音量が掛かっているのでそのまま返す
+    """
+    if isinstance(music, main2.Music):
+        for block in music.iter_blocks(block_size):
+            block *= volume
+            yield block
+    else:
+        yield from music.iter_blocks(block_size)
+
+
+def render_to_wav(music, path, format='pcm16', block_size=BLOCK_SIZE,
+                  volume=0.1):
+    """曲をブロックごとに生成しながらWAVファイルへ書き出す
+
+    書き出したサンプル数を返す
+    """
+    with WavWriter(path, music_rate(music), format,
+                   getattr(music, 'channels', 1)) as writer:
+        for block in iter_music_blocks(music, block_size, volume):
+            writer.write(block)
+    return writer.frames
+
+
+def render_to_memmap(music, path, volume=0.1, window=MEMMAP_WINDOW):
+    """曲をnp.memmapを通して32ビット浮動小数点のWAVファイルへ書き出す
+
+    パートの合成はファイルを割り当てたメモリの中で行うので，曲全体の
+    合成波形を作らない．書き出したサンプル数を返す
+    """
+    if isinstance(music, main2.Music):
+        return music.render_to_file(path, volume, window)
+    if isinstance(music, Music):
+        return music.render_to_file(path, window)
+    raise TypeError('--memmap needs a Music instance, not {}'.format(
+        type(music).__name__))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='曲をWAVファイルへ書き出す')
+    parser.add_argument(
+        'score', help='曲の名前({})または"モジュール名:関数名"'.format(
+            ', '.join(SCORES)))
+    parser.add_argument('-o', '--output', help='出力先(省略時は"曲名.wav")')
+    parser.add_argument('--format', choices=FORMATS, default='pcm16',
+                        help='サンプルの形式(デフォルト: pcm16)')
+    parser.add_argument('--bpm', type=float, help='曲の関数に渡すbpm')
+    parser.add_argument('--volume', type=float, default=0.1,
+                        help='main2.pyの曲に掛ける音量(デフォルト: 0.1)')
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE,
+                        help='一度に生成・書き込みするサンプル数')
+    parser.add_argument('--memmap', action='store_true',
+                        help='np.memmapで割り当てたファイルへ直接書き込む'
+                             '(float32で出力する)')
+    parser.add_argument('--window', type=int, default=MEMMAP_WINDOW,
+                        help='--memmapで一度に割り当てるサンプル数')
+    args = parser.parse_args()
+
+    try:
+        music = load_score(args.score, args.bpm)
+    except TypeError as e:
+        parser.error(e)
+    output = args.output or args.score.rpartition(':')[2] + '.wav'
+    if args.memmap:
+        frames = render_to_memmap(music, output, args.volume, args.window)
+    else:
+        frames = render_to_wav(music, output, args.format, args.block_size,
+                               args.volume)
+    print('{}: {} samples ({:.1f} s)'.format(
+        output, frames, frames / music_rate(music)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""下書き用に低いサンプルレートで生成した波形を出力のレートに変換する
+
+quality='preview'の時は曲をPREVIEW_RATEで生成し，線形補間で出力の
+レートへ変換する．合成するサンプル数が1/4になるので速く鳴らせるが，
+PREVIEW_RATEの半分(5512.5Hz)を超える音は正しく鳴らない
+"""
+
+import math
+
+import numpy as np
+
+
+QUALITIES = ('full', 'preview')
+PREVIEW_RATE = 11025
+
+
+def render_rate(rate, quality='full'):
+    """品質qualityで曲を生成するサンプルレートを返す
+
+    rate : 出力のサンプルレート
+    """
+    if quality == 'full':
+        return rate
+    if quality == 'preview':
+        return min(PREVIEW_RATE, rate)
+    raise ValueError('unknown quality: {!r}'.format(quality))
+
+
+def resampled_length(n, src_rate, dst_rate):
+    """src_rateのn個のサンプルをdst_rateに変換した時のサンプル数
+
+    入力の長さn / src_rate秒より前にある出力のサンプルの数
+    """
+    return -(-n * dst_rate // src_rate)
+
+
+def _ratio(src_rate, dst_rate):
+    """出力up個が入力down個に当たる既約の(up, down)を返す"""
+    gcd = math.gcd(src_rate, dst_rate)
+    return dst_rate // gcd, src_rate // gcd
+
+
+def _rows(samples, rows, up, down):
+    """samples[0]を位置0として，出力のrows * up個のサンプルを求める
+
+    出力のk番目は入力のk * down / upの位置を線形補間した値．
+    samplesの長さはrows * down + 1以上であること
+    """
+    if down == 1:
+        # 整数倍の時は出力を(rows, up)に並べると列ごとに補間の割合が
+        # 同じなので，位置を探さずにブロードキャストで求まる
+        fracs = (np.arange(up) / up).astype(samples.dtype)
+        fracs = fracs.reshape((up,) + (1,) * (samples.ndim - 1))
+        left = samples[:rows]
+        out = (samples[1:rows + 1] - left)[:, np.newaxis] * fracs
+        out += left[:, np.newaxis]
+        return out.reshape((rows * up,) + samples.shape[1:])
+
+    positions = np.arange(rows * up) * (down / up)
+    xp = np.arange(len(samples))
+    if samples.ndim == 1:
+        out = np.interp(positions, xp, samples)
+    else:
+        out = np.empty((len(positions), samples.shape[1]))
+        for channel in range(samples.shape[1]):
+            out[:, channel] = np.interp(positions, xp, samples[:, channel])
+    return out.astype(samples.dtype, copy=False)
+
+
+def _pad(samples, size):
+    """長さがsizeになるまでsamplesの後ろに最後のサンプルを並べる"""
+    if len(samples) >= size:
+        return samples
+    return np.concatenate(
+        [samples, np.repeat(samples[-1:], size - len(samples), axis=0)])
+
+
+def resample(wave, src_rate, dst_rate):
+    """波形全体をsrc_rateからdst_rateへ線形補間で変換する
+
+    waveは1次元(モノラル)または(サンプル数, チャンネル数)のndarray．
+    最後のサンプルより後ろの位置は最後のサンプルの値にする
+    """
+    if src_rate == dst_rate or len(wave) == 0:
+        return wave
+    up, down = _ratio(src_rate, dst_rate)
+    n = resampled_length(len(wave), src_rate, dst_rate)
+    rows = -(-n // up)
+    return _rows(_pad(wave, rows * down + 1), rows, up, down)[:n]
+
+
+class Resampler(object):
+    """ブロックごとに届く波形をresample()と同じ結果になるよう変換するクラス
+
+    出力はup個ずつ(入力down個分)まとめて求め，次のまとまりに必要な
+    入力(down個以下)だけをブロックをまたいで持ち越す
+    """
+
+    def __init__(self, src_rate, dst_rate):
+        self.src_rate = src_rate
+        self.dst_rate = dst_rate
+        self.up, self.down = _ratio(src_rate, dst_rate)
+        self.consumed = 0  # これまでに受け取った入力のサンプル数
+        self.emitted = 0  # これまでに返した出力のサンプル数
+        self._pending = None  # まだ出力に変換していない入力
+
+    def process(self, block):
+        """blockを受け取り，変換できた分の出力を返す"""
+        self.consumed += len(block)
+        if self._pending is not None:
+            block = np.concatenate([self._pending, block])
+        rows = max((len(block) - 1) // self.down, 0)
+        self._pending = block[rows * self.down:].copy()
+        out = _rows(block, rows, self.up, self.down)
+        self.emitted += len(out)
+        return out
+
+    def flush(self):
+        """入力が終わった後に残りの出力を返す
+
+        出力の合計はresampled_length(入力のサンプル数)になる
+        """
+        if self._pending is None or len(self._pending) == 0:
+            return np.zeros(0)
+        rest = resampled_length(self.consumed, self.src_rate,
+                                self.dst_rate) - self.emitted
+        rows = -(-rest // self.up)
+        samples = _pad(self._pending, rows * self.down + 1)
+        out = _rows(samples, rows, self.up, self.down)[:rest]
+        self.emitted += len(out)
+        self._pending = None
+        return out
+
+
+def resample_blocks(blocks, src_rate, dst_rate):
+    """ブロックの列を変換しながら返すジェネレータ"""
+    if src_rate == dst_rate:
+        yield from blocks
+        return
+    resampler = Resampler(src_rate, dst_rate)
+    for block in blocks:
+        out = resampler.process(block)
+        if len(out):
+            yield out
+    rest = resampler.flush()
+    if len(rest):
+        yield rest
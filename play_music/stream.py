@@ -0,0 +1,294 @@
+"""波形をブロックごとに生成しながら鳴らすためのストリーム再生
+
+AudioOutputは(サンプルレート, チャンネル数, 形式)ごとに1つだけ
+出力ストリームを開いたまま使い回す．曲はそのストリームの再生待ちの列に
+入り，前の曲が終わるとすぐ次の曲が鳴るので，曲ごとにデバイスを開き直す
+待ち時間や曲間の隙間ができない
+
+ストリームはPyAudioのコールバックではなく，書き込みスレッドからの
+ブロッキングのwrite()で鳴らす．曲ごとの先読みのスレッドとリングバッファは
+コールバックの時と同じで，最初のブロックができればすぐ鳴り始める．
+コールバックは毎回要求された数のフレームをブロックせずに返す必要があり，
+開いたままのストリームでは曲の合間や生成が遅れた時に無音を埋め続けるか，
+止めたストリームを次の曲で開始し直す(その間の競合を扱う)ことになる．
+write()はデバイスのバッファが空くまで待つので，待ち行列の曲をそのまま
+順に書けば生成の速さも再生に合わせて抑えられる
+"""
+
+import asyncio
+import atexit
+import concurrent.futures
+import queue
+import threading
+import time
+
+import numpy as np
+try:
+    import pyaudio
+except ImportError:  # 再生しない環境(render.pyでの書き出しなど)ではなくてよい
+    pyaudio = None
+
+
+BLOCK_SIZE = 4096  # 1ブロックのサンプル数
+BUFFER_BLOCKS = 4  # リングバッファに先読みしておくブロック数
+FORMATS = ('float32', 'int16')
+
+_output = None
+_output_lock = threading.Lock()
+
+
+def _to_bytes(block, format):
+    """ブロックをストリームに書き込むバイト列にする
+
+    block : 1次元(モノラル)または(サンプル数, チャンネル数)のndarray
+    """
+    if format == 'int16':
+        block = np.clip(block, -1.0, 1.0) * 32767
+        return np.ascontiguousarray(block, dtype=np.int16).tobytes()
+    return np.ascontiguousarray(block, dtype=np.float32).tobytes()
+
+
+def _pa_format(backend, format):
+    """形式の名前をbackendのopen()に渡す定数にする"""
+    constants = backend if isinstance(backend, MemorySink) else pyaudio
+    return constants.paInt16 if format == 'int16' else constants.paFloat32
+
+
+class MemorySink(object):
+    """PyAudioの代わりに書き込まれたバイト列をメモリに記録する出力先
+
+    音声デバイスのない環境での動作確認に使う．AudioOutput(MemorySink())
+    のように渡すと，開いたストリームごとにwrite()されたバイト列を
+    streams[(rate, channels, format)]のリストに記録する
+    realtime : Trueなら書き込んだサンプル数に応じた時間だけ待つ
+    """
+
+    paFloat32 = 'float32'
+    paInt16 = 'int16'
+
+    def __init__(self, realtime=False):
+        self.realtime = realtime
+        self.streams = {}
+        self.opened = 0
+        self.terminated = False
+
+    def open(self, format, channels, rate, output=True,
+             frames_per_buffer=BLOCK_SIZE):
+        self.opened += 1
+        written = self.streams.setdefault((rate, channels, format), [])
+        return _MemoryStream(written, rate * channels *
+                             np.dtype(format).itemsize, self.realtime)
+
+    def terminate(self):
+        self.terminated = True
+
+    def data(self, rate, channels=1, format='float32'):
+        """書き込まれたサンプルを1つのndarrayにして返す"""
+        written = b''.join(self.streams.get((rate, channels, format), []))
+        return np.frombuffer(written, dtype=format)
+
+
+class _MemoryStream(object):
+
+    def __init__(self, written, bytes_per_second, realtime):
+        self.written = written
+        self.bytes_per_second = bytes_per_second
+        self.realtime = realtime
+        self.closed = False
+
+    def write(self, data):
+        self.written.append(bytes(data))
+        if self.realtime:
+            time.sleep(len(data) / self.bytes_per_second)
+
+    def stop_stream(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class _OutputStream(object):
+    """開いたままの1つの出力ストリームと，その再生待ちの列
+
+    再生待ちの各曲は登録された時点で先読みのスレッドがブロックの生成を
+    始めており，書き込みスレッドは前の曲を書き終えるとすぐ次の曲の
+    ブロックを書き込む．ストリームへの書き込みに失敗した時は，その曲と
+    再生待ちの曲のFutureにその例外を渡し，以後このストリームは使わない
+    """
+
+    def __init__(self, stream, format):
+        self.stream = stream
+        self.format = format
+        self.error = None  # ストリームへの書き込みで起きた例外
+        self.jobs = queue.Queue()
+        self.writer = threading.Thread(target=self._write_jobs, daemon=True)
+        self.writer.start()
+
+    def submit(self, blocks, buffer_blocks):
+        future = concurrent.futures.Future()
+        ring = queue.Queue(maxsize=buffer_blocks)
+        cancelled = threading.Event()
+
+        def produce():
+            try:
+                for block in blocks:
+                    if cancelled.is_set():  # 鳴らせなくなった曲は生成をやめる
+                        break
+                    ring.put(_to_bytes(block, self.format))
+            except BaseException as e:  # 書き込みスレッドからFutureに渡す
+                ring.put(e)
+            finally:
+                ring.put(None)  # 終わりの印
+
+        threading.Thread(target=produce, daemon=True).start()
+        self.jobs.put((ring, cancelled, future))
+        return future
+
+    def _write_jobs(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            ring, cancelled, future = job
+            error = self.error
+            while True:
+                if error is not None:
+                    cancelled.set()
+                data = ring.get()  # 失敗した後も先読みのスレッドが終わるまで読む
+                if data is None:
+                    break
+                if isinstance(data, BaseException):
+                    error = error or data
+                    continue
+                if error is None:
+                    try:
+                        self.stream.write(data)
+                    except Exception as e:
+                        error = self.error = e
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    def close(self):
+        """再生待ちの曲を鳴らし終えてからストリームを閉じる"""
+        self.jobs.put(None)
+        self.writer.join()
+        try:
+            self.stream.stop_stream()
+        finally:
+            self.stream.close()
+
+
+class AudioOutput(object):
+    """出力ストリームを開いたまま使い回して曲を鳴らすクラス
+
+    backend : PyAudio互換のopen()/terminate()をもつオブジェクト．
+              NoneならPyAudio()を最初に鳴らす時に作る
+    """
+
+    def __init__(self, backend=None):
+        self._backend = backend
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _stream(self, rate, channels, format, block_size):
+        key = (rate, channels, format)
+        with self._lock:
+            stream = self._streams.get(key)
+            if stream is not None and stream.error is not None:
+                # 書き込みに失敗したストリームは閉じて開き直す
+                threading.Thread(target=self._close_broken, args=(stream,),
+                                 daemon=True).start()
+                stream = None
+            if stream is None:
+                if self._backend is None:
+                    self._backend = pyaudio.PyAudio()
+                stream = _OutputStream(self._backend.open(
+                    format=_pa_format(self._backend, format),
+                    channels=channels, rate=rate,
+                    output=True, frames_per_buffer=block_size), format)
+                self._streams[key] = stream
+        return stream
+
+    @staticmethod
+    def _close_broken(stream):
+        try:
+            stream.close()
+        except Exception:  # 壊れたストリームを閉じる時のエラーは無視する
+            pass
+
+    def submit(self, blocks, rate, channels=1, format='float32',
+               block_size=BLOCK_SIZE, buffer_blocks=BUFFER_BLOCKS):
+        """ブロック列を再生待ちの列に入れ，すぐにFutureを返す
+
+        Futureは最後のブロックを書き込んだ時に完了する．ブロックの生成や
+        ストリームへの書き込みで例外が起きた時はその例外で完了する
+        blocks : 1次元(モノラル)または(サンプル数, channels)のndarrayを
+                 順に返すイテラブル
+        format : 'float32'または'int16'
+        buffer_blocks : 先読みしておくブロック数の上限
+        """
+        if format not in FORMATS:
+            raise ValueError('unknown format: {!r}'.format(format))
+        stream = self._stream(rate, channels, format, block_size)
+        return stream.submit(blocks, buffer_blocks)
+
+    def play_blocks(self, blocks, rate, channels=1, format='float32',
+                    block_size=BLOCK_SIZE, buffer_blocks=BUFFER_BLOCKS):
+        """ブロック列を鳴らし終えるまで待つ"""
+        self.submit(blocks, rate, channels, format, block_size,
+                    buffer_blocks).result()
+
+    async def play(self, blocks, rate, channels=1, format='float32',
+                   block_size=BLOCK_SIZE, buffer_blocks=BUFFER_BLOCKS):
+        """ブロック列を鳴らすコルーチン．イベントループを止めずに待つ"""
+        await asyncio.wrap_future(self.submit(
+            blocks, rate, channels, format, block_size, buffer_blocks))
+
+    def close(self):
+        """再生待ちの曲を鳴らし終えてから全てのストリームを閉じる"""
+        with self._lock:
+            streams = list(self._streams.values())
+            self._streams.clear()
+        for stream in streams:
+            if stream.error is None:
+                stream.close()
+            else:
+                self._close_broken(stream)
+        if self._backend is not None:
+            self._backend.terminate()
+            self._backend = None
+
+
+def get_output():
+    """プロセスで共有するAudioOutputを返す．終了時に自動で閉じる"""
+    global _output
+    with _output_lock:
+        if _output is None:
+            _output = AudioOutput()
+            atexit.register(_output.close)
+    return _output
+
+
+def play_blocks(blocks, rate, block_size=BLOCK_SIZE,
+                buffer_blocks=BUFFER_BLOCKS):
+    """波形のブロック列を共有のAudioOutputで鳴らし終えるまで待つ
+
+    生成スレッドがblocksから1ブロックずつ取り出してリングバッファに入れ，
+    書き込みスレッドがそれを取り出して再生する．最初のブロックが
+    できた時点で再生を始めるので，曲の長さによらず最初の音は1ブロック分の
+    生成時間で鳴り始める
+    blocks : 長さblock_size以下の1次元ndarrayを順に返すイテラブル
+    rate : サンプルレート
+    buffer_blocks : リングバッファに保持するブロック数の上限
+    """
+    get_output().play_blocks(blocks, rate, block_size=block_size,
+                             buffer_blocks=buffer_blocks)
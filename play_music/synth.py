@@ -0,0 +1,68 @@
+"""sin波の生成"""
+
+import math
+
+import numpy as np
+
+
+MAX_BLOCK_BYTES = 8 * 1024 * 1024  # 一度に計算する2次元配列の大きさの上限
+PHASE_BLOCK = 1024  # 単精度で計算する時に位相を2πで割った余りに戻す間隔
+
+
+def sine(freq, n, rate, dtype=np.float64, phase=0.0):
+    """周波数freq，長さnのsin波を返す
+
+    dtype : 波形の型．np.float32の時は，PHASE_BLOCKサンプルごとの位相の
+            基点だけを倍精度で求めて2πで割った余りに戻すので，
+            長い音でも単精度の位相の誤差が積もらない
+    phase : 始まりの位相(1周期を1とする)
+    """
+    step = (2 * math.pi) * freq / rate  # 2πf*(1/rate)
+    offset = 2 * math.pi * phase
+    if np.dtype(dtype) == np.float64:
+        wave = step * np.arange(n)
+        if offset:
+            wave += offset
+        return np.sin(wave, out=wave)  # sin(2πft)
+
+    wave = np.empty(n, dtype=dtype)
+    ramp = np.mod(step * np.arange(PHASE_BLOCK), 2 * math.pi).astype(dtype)
+    bases = np.arange(0, n, PHASE_BLOCK) * step + offset
+    np.mod(bases, 2 * math.pi, out=bases)
+
+    full = n // PHASE_BLOCK  # PHASE_BLOCKごとの位相 = 基点 + ramp
+    blocks = wave[:full * PHASE_BLOCK].reshape(full, PHASE_BLOCK)
+    np.add(bases[:full, np.newaxis], ramp, out=blocks, casting='same_kind')
+    np.add(bases[full:], ramp[:n - full * PHASE_BLOCK],
+           out=wave[full * PHASE_BLOCK:], casting='same_kind')
+    return np.sin(wave, out=wave)
+
+
+def sines(freqs, first, last, rate, dtype=np.float64):
+    """周波数freqsのsin波のfirstからlastまでのサンプルを行とする2次元配列
+
+    周波数×時間のブロードキャストで一度に計算する
+    """
+    steps = (2 * math.pi / rate) * np.asarray(freqs, dtype=np.float64)
+    block = np.multiply.outer(steps, np.arange(first, last))
+    if np.dtype(dtype) != np.float64:  # 位相を小さくしてから精度を落とす
+        np.mod(block, 2 * math.pi, out=block)
+        block = block.astype(dtype)
+    return np.sin(block, out=block)  # sin(2πft)
+
+
+def sum_of_sines(freqs, n, rate, dtype=np.float64,
+                 max_block_bytes=MAX_BLOCK_BYTES):
+    """周波数freqsのsin波(長さn)をすべて足した波形を返す
+
+    周波数×時間の2次元配列に対するブロードキャストで一度に計算する．
+    2次元配列がmax_block_bytesを超えないよう時間方向に分けて計算する
+    """
+    out = np.empty(n, dtype=dtype)
+
+    columns = max(1, max_block_bytes // (8 * len(freqs)))
+    for first in range(0, n, columns):
+        last = min(n, first + columns)
+        block = sines(freqs, first, last, rate, dtype)
+        np.sum(block, axis=0, out=out[first:last])
+    return out
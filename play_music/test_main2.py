@@ -0,0 +1,99 @@
+"""main2で同じ構造の部分木を1度だけ描くことを確かめるテスト
+
+python -m pytest または python -m unittest で実行する
+"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import main2
+from cache import wave_cache
+from envelope import envelope_cache
+from main2 import Chord, Music, Note, Series
+
+SCALES = ['c4', 'd4', 'e4', 'f4', 'g4', 'a4', 'b4', 'c5']
+
+
+def phrase():
+    """8種類の音符を並べた128個の要素からなるフレーズ"""
+    series = Series()
+    for i in range(128):
+        series.add_tone(SCALES[i % len(SCALES)], 0.25)
+    return series
+
+
+def copies():
+    """同じフレーズを別々に16個作って並べた曲"""
+    return Series([phrase() for _ in range(16)])
+
+
+class SharedSubtreeTest(unittest.TestCase):
+
+    def setUp(self):
+        wave_cache.clear()
+        envelope_cache.clear()
+        main2.subtree_cache.clear()
+
+    def count_leaf_renders(self, render):
+        """render(music)の間に音符の波形を合成した回数を返す"""
+        targets = [(Note, '_generate_wave'), (Note, '_render_into'),
+                   (Chord, '_uniform_wave')]
+        patches = [mock.patch.object(cls, name, autospec=True,
+                                     side_effect=getattr(cls, name))
+                   for cls, name in targets]
+        mocks = [patch.start() for patch in patches]
+        try:
+            self.result = render(Music(copies(), bpm=120))
+        finally:
+            for patch in patches:
+                patch.stop()
+        return sum(m.call_count for m in mocks)
+
+    def test_each_structure_is_synthesized_once(self):
+        def render_file(music):
+            with tempfile.TemporaryDirectory() as directory:
+                music.render_to_file(os.path.join(directory, 'song.wav'))
+
+        renders = {
+            'inplace': lambda music: music.generate_wave('inplace'),
+            'recursive': lambda music: music.generate_wave('recursive'),
+            'iterative': lambda music: music.generate_wave('iterative'),
+            'blocks': lambda music: list(music.iter_blocks()),
+            'file': render_file,
+        }
+        for name, render in renders.items():
+            with self.subTest(name):
+                self.setUp()
+                self.assertEqual(self.count_leaf_renders(render),
+                                 len(SCALES))
+
+    def test_shared_waves_match_recursive(self):
+        expected = Music(copies(), bpm=120).generate_wave('recursive')
+        self.setUp()
+        music = Music(copies(), bpm=120)
+        np.testing.assert_array_equal(music.generate_wave('inplace'),
+                                      expected)
+        np.testing.assert_array_equal(
+            np.concatenate(list(music.iter_blocks(1000))), expected)
+
+    def test_edited_copy_is_rendered_again(self):
+        music = Music(copies(), bpm=120)
+        music.generate_wave('inplace')
+        music.component.components[3].components[5].components[0].scale = \
+            'c3'
+
+        edited = copies()
+        edited.components[3].components[5].components[0].scale = 'c3'
+        expected = Music(edited, bpm=120).generate_wave('recursive')
+        np.testing.assert_array_equal(music.generate_wave('inplace'),
+                                      expected)
+        np.testing.assert_array_equal(
+            np.concatenate(list(music.iter_blocks())), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
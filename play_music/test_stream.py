@@ -0,0 +1,117 @@
+"""stream.AudioOutputをMemorySinkに向けて確かめるテスト
+
+音声デバイスは使わない．python -m pytest または python -m unittest で実行する
+"""
+
+import asyncio
+import unittest
+
+import numpy as np
+
+from stream import AudioOutput, MemorySink
+
+RATE = 8000
+
+
+def blocks(value, count, size=100):
+    """値valueのブロックをcount個返すジェネレータ"""
+    for _ in range(count):
+        yield np.full(size, value)
+
+
+def failing_blocks():
+    yield np.ones(100)
+    raise RuntimeError('boom')
+
+
+class FailingSink(MemorySink):
+    """failがTrueの間に開いたストリームのwrite()がOSErrorを送出する出力先"""
+
+    fail = True
+
+    def open(self, *args, **kwargs):
+        stream = super().open(*args, **kwargs)
+        if self.fail:
+            def write(data):
+                raise OSError('device gone')
+
+            stream.write = write
+        return stream
+
+
+class AudioOutputTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sink = MemorySink()
+        self.output = AudioOutput(self.sink)
+
+    def tearDown(self):
+        self.output.close()
+
+    def test_back_to_back_songs_share_one_stream(self):
+        futures = [self.output.submit(blocks(value, 20), RATE)
+                   for value in (0.25, 0.5, 0.75)]
+        for future in futures:
+            future.result(timeout=10)
+
+        data = self.sink.data(RATE)
+        expected = np.repeat([0.25, 0.5, 0.75], 2000).astype(np.float32)
+        np.testing.assert_array_equal(data, expected)
+        self.assertEqual(self.sink.opened, 1)
+
+    def test_streams_are_kept_per_rate_channels_and_format(self):
+        self.output.play_blocks(blocks(0.5, 2), RATE)
+        self.output.play_blocks(blocks(0.5, 2), RATE, format='int16')
+        self.output.play_blocks(blocks(0.5, 2), RATE * 2)
+        self.output.play_blocks(blocks(0.5, 2), RATE)
+        self.assertEqual(self.sink.opened, 3)
+        self.assertEqual(len(self.sink.data(RATE)), 400)
+        np.testing.assert_array_equal(
+            self.sink.data(RATE, format='int16'), np.full(200, 16383))
+
+    def test_error_while_generating_fails_only_that_song(self):
+        failed = self.output.submit(failing_blocks(), RATE)
+        after = self.output.submit(blocks(0.5, 3), RATE)
+
+        with self.assertRaisesRegex(RuntimeError, 'boom'):
+            failed.result(timeout=10)
+        after.result(timeout=10)
+        # 失敗した曲は例外までのブロックだけが書き込まれる
+        self.assertEqual(len(self.sink.data(RATE)), 400)
+
+    def test_error_while_writing_fails_queued_songs_and_reopens(self):
+        sink = FailingSink()
+        with AudioOutput(sink) as output:
+            futures = [output.submit(blocks(0.5, 50), RATE)
+                       for _ in range(3)]
+            for future in futures:
+                with self.assertRaisesRegex(OSError, 'device gone'):
+                    future.result(timeout=10)
+
+            sink.fail = False  # デバイスが戻れば開き直して鳴らせる
+            output.play_blocks(blocks(0.5, 2), RATE)
+        self.assertEqual(len(sink.data(RATE)), 200)
+
+    def test_play_async(self):
+        async def play_all():
+            await asyncio.gather(self.output.play(blocks(0.25, 5), RATE),
+                                 self.output.play(blocks(0.5, 5), RATE))
+
+        asyncio.run(play_all())
+        np.testing.assert_array_equal(
+            self.sink.data(RATE),
+            np.repeat([0.25, 0.5], 500).astype(np.float32))
+
+    def test_close_plays_queued_songs_then_terminates(self):
+        sink = MemorySink(realtime=True)
+        output = AudioOutput(sink)
+        futures = [output.submit(blocks(0.5, 4), RATE) for _ in range(2)]
+        output.close()
+
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(len(sink.data(RATE)), 800)
+        self.assertTrue(sink.terminated)
+
+
+if __name__ == '__main__':
+    unittest.main()
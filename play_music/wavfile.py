@@ -0,0 +1,116 @@
+"""波形をブロックごとにWAVファイルへ書き出す"""
+
+import struct
+import wave
+
+import numpy as np
+
+
+FORMATS = ('pcm16', 'float32')
+WAVE_FORMAT_IEEE_FLOAT = 3
+MEMMAP_WINDOW = 1 << 20  # render_wav_memmap()で一度に割り当てるサンプル数
+
+
+def float_wav_header(rate, channels, frames):
+    """32ビット浮動小数点のWAVファイルのヘッダを返す
+
+    標準のwaveモジュールは整数PCMしか書き出せないので自前で作る
+    frames : 1チャンネルあたりのサンプル数
+    """
+    block_align = 4 * channels
+    data_size = frames * block_align
+    return b''.join([
+        b'RIFF', struct.pack('<I', 50 + data_size), b'WAVE',
+        b'fmt ', struct.pack('<IHHIIHHH', 18, WAVE_FORMAT_IEEE_FLOAT,
+                             channels, rate, rate * block_align,
+                             block_align, 32, 0),
+        b'fact', struct.pack('<II', 4, frames),
+        b'data', struct.pack('<I', data_size),
+    ])
+
+
+FLOAT_HEADER_SIZE = len(float_wav_header(44100, 1, 0))
+
+
+class WavWriter(object):
+    """ブロックごとに波形を受け取ってWAVファイルへ書き込むクラス
+
+    受け取ったブロックはすぐにファイルへ書き出すので，曲の長さによらず
+    メモリ使用量は1ブロック分で済む
+    path : 書き出すファイルのパス
+    rate : サンプルレート
+    format : 'pcm16' (16ビット整数) または 'float32' (32ビット浮動小数点)
+    channels : チャンネル数．2以上の時はwrite()に(サンプル数, チャンネル数)の
+               配列を渡す
+    """
+
+    def __init__(self, path, rate, format='pcm16', channels=1):
+        if format not in FORMATS:
+            raise ValueError('unknown format: {!r}'.format(format))
+        self.rate = rate
+        self.format = format
+        self.channels = channels
+        self.frames = 0
+
+        if format == 'pcm16':
+            self._file = wave.open(path, 'wb')
+            self._file.setnchannels(channels)
+            self._file.setsampwidth(2)
+            self._file.setframerate(rate)
+        else:
+            self._file = open(path, 'wb')
+            self._file.write(float_wav_header(rate, channels, 0))
+
+    def write(self, block):
+        """波形のブロックを書き込む．値は-1から1の範囲を想定する"""
+        if self.format == 'pcm16':
+            samples = np.clip(block, -1, 1) * 32767
+            self._file.writeframes(samples.astype('<i2').tobytes())
+        else:
+            self._file.write(np.asarray(block, dtype='<f4').tobytes())
+        self.frames += len(block)
+
+    def close(self):
+        """ヘッダのサイズを書き直してファイルを閉じる"""
+        if self.format == 'float32':
+            self._file.seek(0)
+            self._file.write(float_wav_header(self.rate, self.channels,
+                                              self.frames))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def render_wav_memmap(path, rate, frames, render_window,
+                      window=MEMMAP_WINDOW, channels=1):
+    """32ビット浮動小数点のWAVファイルを作り，np.memmapを通して書き込む
+
+    ファイルは先に全体の大きさで作ってヘッダを書いておき，先頭から
+    windowサンプルずつファイルの一部だけをメモリに割り当てて
+    render_window(out, start)に渡す．render_windowはoutに直接波形を
+    書き込む(足し込む)こと．outは0で初期化されている．割り当てた範囲は
+    書き込み後すぐに解放するので，曲の長さによらずメモリ使用量は
+    windowサンプル分で済む
+    frames : 1チャンネルあたりの全体のサンプル数
+    render_window : 関数(out, start)．startはoutの先頭の曲の上での位置
+    channels : 2以上の時，outは(サンプル数, チャンネル数)の配列になる
+    """
+    with open(path, 'wb') as f:
+        f.write(float_wav_header(rate, channels, frames))
+        f.truncate(FLOAT_HEADER_SIZE + 4 * channels * frames)  # 残りは0
+
+    for start in range(0, frames, window):
+        shape = (min(window, frames - start),)
+        if channels > 1:
+            shape += (channels,)
+        out = np.memmap(path, dtype='<f4', mode='r+',
+                        offset=FLOAT_HEADER_SIZE + 4 * channels * start,
+                        shape=shape)
+        render_window(out, start)
+        out.flush()
+        del out  # 割り当てを解放する
+    return frames